@@ -9,15 +9,246 @@ import struct
 import os
 import logging
 import json
-from collections import defaultdict
-from time import time
+import heapq
+import threading
+from collections import deque
+from time import time, sleep
 
 TYPE_53_DHCPDISCOVER = 1
 TYPE_53_DHCPREQUEST =  3
 
+# the options read from requests: message type, vendor class, client
+# architecture, user class, client machine identifier, parameter request list
+OPTIONS_USED = frozenset([53, 60, 93, 77, 97, 55])
+
 class OutOfLeasesError(Exception):
     pass
 
+class MalformedPacketError(Exception):
+    pass
+
+class AddressPool:
+    '''
+        The addresses of a lease range which are free to offer. Addresses
+        never handed out go first, lowest first, then those released, in
+        the order they were released so the most recent are reused last; a
+        heap of lease expiry times puts addresses back as their leases
+        lapse. Addresses are handled as 32-bit integers inside, dotted
+        strings outside.
+    '''
+    def __init__(self, first, last):
+        self.first = self.encode(first)
+        self.last = self.encode(last)
+        self.used = bytearray(max(0, self.last - self.first + 1))
+        self.fresh = self.first # lowest address never handed out
+        self.free = deque() # released addresses
+        self.expiry = [] # heap of (expire, address, mac)
+        self.static = set() # never handed out or put back
+
+    def encode(self, address):
+        '''e.g '192.168.1.1' to 3232235777'''
+        return struct.unpack('!I', socket.inet_aton(address))[0]
+
+    def decode(self, address):
+        '''e.g 3232235777 to '192.168.1.1' '''
+        return socket.inet_ntoa(struct.pack('!I', address))
+
+    def reserve(self, address, static = False):
+        '''Takes an address out of the pool, for good if static.'''
+        address = self.encode(address)
+        if static:
+            self.static.add(address)
+        if self.first <= address <= self.last:
+            # allocate() skips it
+            self.used[address - self.first] = 1
+
+    def allocate(self):
+        '''Returns the free address first in line.'''
+        while self.fresh <= self.last:
+            address = self.fresh
+            self.fresh += 1
+            # skip the X.Y.Z.0 addresses
+            if address % 256 and not self.used[address - self.first]:
+                self.used[address - self.first] = 1
+                return self.decode(address)
+        while self.free:
+            address = self.free.popleft()
+            if not self.used[address - self.first]:
+                self.used[address - self.first] = 1
+                return self.decode(address)
+        raise OutOfLeasesError('Ran out of IP addresses to lease!')
+
+    def release(self, address):
+        '''Puts an address back in the pool.'''
+        address = self.encode(address)
+        if self.first <= address <= self.last and address not in self.static and self.used[address - self.first]:
+            self.used[address - self.first] = 0
+            self.free.append(address)
+
+    def set_static(self, addresses):
+        '''
+            Replaces the static addresses. Returns those no longer static,
+            which stay taken until released or leased.
+        '''
+        addresses = set(self.encode(address) for address in addresses)
+        removed = self.static - addresses
+        self.static = addresses
+        for address in addresses:
+            if self.first <= address <= self.last:
+                self.used[address - self.first] = 1
+        return [self.decode(address) for address in removed]
+
+    def lease(self, address, mac, expire):
+        '''Records when the lease of an address lapses.'''
+        if self.encode(address) not in self.static:
+            heapq.heappush(self.expiry, (expire, self.encode(address), mac))
+
+    def lapsed(self, now):
+        '''Yields the (address, mac) leases which lapsed by now.'''
+        while self.expiry and self.expiry[0][0] <= now:
+            expire, address, mac = heapq.heappop(self.expiry)
+            yield self.decode(address), mac
+
+class Lease:
+    '''A client's lease; ip is empty until an address is assigned.'''
+    __slots__ = ('ip', 'expire', 'ipxe')
+
+    def __init__(self, ip = '', expire = 0, ipxe = False):
+        self.ip = ip
+        self.expire = expire
+        self.ipxe = ipxe
+
+class StaticBinding:
+    '''
+        A client's settings from the static config, with its options
+        encoded ready to send; None where the config has no setting.
+    '''
+    __slots__ = ('ipaddr', 'subnet', 'router', 'dns', 'rom')
+
+    def __init__(self, ipaddr = None, subnet = None, router = None, dns = None, rom = None):
+        self.ipaddr = ipaddr
+        self.subnet = subnet
+        self.router = router
+        self.dns = dns
+        self.rom = rom
+
+class LeaseJournal:
+    '''
+        Keeps the leases saved in `path` safe across crashes without
+        rewriting them all on every change. Each change is appended to
+        path.journal as a line of JSON, and run() syncs the journal to disk
+        at most every `sync_interval` seconds. Once the journal grows past
+        `compact_size` bytes, run() folds it into a new snapshot at path,
+        written in the format export_leases() has always used.
+    '''
+    def __init__(self, path, sync_interval = 1, compact_size = 1048576):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.sync_interval = sync_interval
+        self.compact_size = compact_size
+        self.leases = dict() # MAC string -> (ip, expire, ipxe), as last journalled
+        self.lock = threading.Lock()
+        self.fd = None
+        self.size = 0
+        self.dirty = False
+
+    def load(self):
+        '''
+            Returns the leases from the snapshot and the journals, which are
+            then compacted into a new snapshot.
+        '''
+        try:
+            with open(self.path, 'r') as snapshot:
+                for mac, lease in json.load(snapshot).items():
+                    self.leases[mac] = (lease['ip'], lease['expire'], lease['ipxe'])
+        except (IOError, ValueError, KeyError):
+            pass
+        # a journal left behind by an interrupted compaction comes first
+        for name in (self.journal_path + '.old', self.journal_path):
+            try:
+                with open(name, 'r') as journal:
+                    for line in journal:
+                        try:
+                            mac, lease = json.loads(line)
+                            if lease is None: # reaped
+                                self.leases.pop(mac, None)
+                            else:
+                                self.leases[mac] = (lease['ip'], lease['expire'], lease['ipxe'])
+                        except (ValueError, TypeError, KeyError):
+                            break # torn by a crash mid-write
+            except IOError:
+                pass
+        self.write_snapshot(self.leases)
+        for name in (self.journal_path + '.old', self.journal_path):
+            if os.path.exists(name):
+                os.unlink(name)
+        self.fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return dict((mac, Lease(*lease)) for mac, lease in self.leases.items())
+
+    def append(self, mac, lease):
+        '''Journals the Lease of mac, or None if it was reaped; it is on disk by the next sync.'''
+        if lease is None:
+            line = json.dumps([mac, None])
+        else:
+            line = json.dumps([mac, {'ip': lease.ip, 'expire': lease.expire, 'ipxe': lease.ipxe}])
+        line = (line + '\n').encode('ascii')
+        with self.lock:
+            if lease is None:
+                self.leases.pop(mac, None)
+            else:
+                self.leases[mac] = (lease.ip, lease.expire, lease.ipxe)
+            os.write(self.fd, line)
+            self.size += len(line)
+            self.dirty = True
+
+    def flush(self):
+        '''Syncs the journal to disk now.'''
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.fd)
+                self.dirty = False
+
+    def run(self):
+        '''Syncs the journal in batches and compacts it, forever.'''
+        while True:
+            sleep(self.sync_interval)
+            with self.lock:
+                dirty, self.dirty = self.dirty, False
+            # only this thread closes self.fd, so it can be synced unlocked
+            if dirty:
+                os.fsync(self.fd)
+            if self.size >= self.compact_size:
+                self.compact()
+
+    def compact(self):
+        '''Folds the journal into a new snapshot, called from run().'''
+        with self.lock:
+            # later changes go to a new journal while the snapshot is written
+            os.fsync(self.fd)
+            os.close(self.fd)
+            os.rename(self.journal_path, self.journal_path + '.old')
+            self.fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.size = 0
+            self.dirty = False
+            leases = dict(self.leases)
+        self.write_snapshot(leases)
+        os.unlink(self.journal_path + '.old')
+
+    def write_snapshot(self, leases):
+        '''Replaces the snapshot with leases, atomically.'''
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as snapshot:
+            json.dump(dict((mac, {'ip': ip, 'expire': expire, 'ipxe': ipxe})
+                           for mac, (ip, expire, ipxe) in leases.items()), snapshot)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
 class DHCPD:
     '''
         This class implements a DHCP Server, limited to PXE options.
@@ -55,11 +286,14 @@ class DHCPD:
         self.http = server_settings.get('use_http', False)
         self.mode_proxy = server_settings.get('mode_proxy', False) # ProxyDHCP mode
         self.static_config = server_settings.get('static_config', dict())
+        self.static_config_file = server_settings.get('static_config_file', '')
         self.whitelist = server_settings.get('whitelist', False)
         self.mode_verbose = server_settings.get('mode_verbose', False) # debug mode
         self.mode_debug = server_settings.get('mode_debug', False) # debug mode
         self.logger = server_settings.get('logger', None)
         self.save_leases_file = server_settings.get('saveleases', '')
+        self.leases_sync_interval = server_settings.get('leases_sync_interval', 1)
+        self.leases_compact_size = server_settings.get('leases_compact_size', 1048576)
         self.magic = struct.pack('!I', 0x63825363) # magic cookie
 
         # setup logger
@@ -95,6 +329,27 @@ class DHCPD:
             self.logger.info('DNS Server: {0}'.format(self.dns_server))
             self.logger.info('Broadcast Address: {0}'.format(self.broadcast))
 
+        # options sent to clients without their own in the static config
+        self.defaults = StaticBinding(subnet = self.tlv_encode(1, socket.inet_aton(self.subnet_mask)),
+                                      router = self.tlv_encode(3, socket.inet_aton(self.router)),
+                                      dns = self.tlv_encode(6, socket.inet_aton(self.dns_server)))
+
+        # replies are patched into a copy of the header template in one
+        # buffer, followed by options templates made once per binding and file
+        self.header_template = self.craft_header_template()
+        self.templates = dict() # (opt53, StaticBinding, file name) -> options
+        self.reply = bytearray(1500) # only the listen thread replies
+
+        # static config by packed MAC, reloaded when static_config_file changes
+        self.bindings = self.compile_static(self.static_config)
+        self.static_config_checked = time()
+        self.static_config_mtime = None
+        if self.static_config_file:
+            try:
+                self.static_config_mtime = os.stat(self.static_config_file).st_mtime
+            except OSError:
+                pass
+
         if self.static_config:
             self.logger.info('Using Static Leasing')
             self.logger.info('Using Static Leasing Whitelist: {0}'.format(self.whitelist))
@@ -111,34 +366,139 @@ class DHCPD:
         self.sock.bind(('', self.port ))
 
         # key is MAC
-        # separate options dict so we don't have to clean up on export
+        # only the options of the request being handled are kept
         self.options = dict()
-        self.leases = defaultdict(lambda: {'ip': '', 'expire': 0, 'ipxe': self.ipxe})
+        self.leases = dict()
+        self.expiring = deque() # (expire, MAC) in order, reaped by reap()
+        self.journal = None
         if self.save_leases_file:
-            try:
-                leases_file = open(self.save_leases_file, 'rb')
-                imported = json.load(leases_file)
-                import_safe = dict()
-                for lease in imported:
-                    packed_mac = struct.pack('BBBBBB', *map(lambda x:int(x, 16), lease.split(':')))
-                    import_safe[packed_mac] = imported[lease]
-                self.leases.update(import_safe)
-                self.logger.info('Loaded leases from {0}'.format(self.save_leases_file))
-            except IOError:
-                pass
-            except ValueError:
-                pass
+            self.journal = LeaseJournal(self.save_leases_file, self.leases_sync_interval, self.leases_compact_size)
+            imported = self.journal.load()
+            import_safe = dict()
+            for lease in imported:
+                packed_mac = struct.pack('BBBBBB', *map(lambda x:int(x, 16), lease.split(':')))
+                import_safe[packed_mac] = imported[lease]
+            self.leases.update(import_safe)
+            self.expiring.extend(sorted((lease.expire, mac) for mac, lease in import_safe.items()))
+            self.logger.info('Loaded leases from {0}'.format(self.save_leases_file))
+            journald = threading.Thread(target = self.journal.run)
+            journald.daemon = True
+            journald.start()
+
+        # the addresses we can offer, less the leased and statically bound ones
+        if not self.mode_proxy:
+            self.pool = AddressPool(self.offer_from, self.offer_to)
+            self.pool.set_static(binding.ipaddr for binding in self.bindings.values() if binding.ipaddr)
+            for mac, lease in self.leases.items():
+                if lease.ip and lease.expire > time():
+                    self.pool.reserve(lease.ip)
+                    self.pool.lease(lease.ip, mac, lease.expire)
 
     def export_leases(self):
-        if self.save_leases_file:
-            export_safe = dict()
-            for lease in self.leases:
-                # translate the key to json safe (and human readable) mac
-                export_safe[self.get_mac(lease)] = self.leases[lease]
-            leases_file = open(self.save_leases_file, 'w')
-            json.dump(export_safe, leases_file)
+        '''Makes sure every lease is saved; they are journalled as they change.'''
+        if self.journal:
+            self.journal.flush()
             self.logger.info('Exported leases to {0}'.format(self.save_leases_file))
 
+    def save_lease(self, client_mac):
+        '''Journals a changed lease.'''
+        if self.journal:
+            # translate the key to json safe (and human readable) mac
+            self.journal.append(self.get_mac(client_mac), self.leases.get(client_mac))
+
+    def get_lease(self, client_mac):
+        '''Returns the Lease of client_mac, made on first use.'''
+        lease = self.leases.get(client_mac)
+        if lease is None:
+            # kept for a lease time even if no address is assigned, for the iPXE flag
+            lease = self.leases[client_mac] = Lease('', time() + 86400, self.ipxe)
+            self.expiring.append((lease.expire, client_mac))
+        return lease
+
+    def reap(self):
+        '''Forgets the leases which have expired, putting their addresses back in the range.'''
+        now = time()
+        if not self.mode_proxy:
+            for address, mac in self.pool.lapsed(now):
+                # unless it was renewed since
+                lease = self.leases.get(mac)
+                if lease is None or lease.ip != address or lease.expire <= now:
+                    self.pool.release(address)
+        while self.expiring and self.expiring[0][0] <= now:
+            expire, mac = self.expiring.popleft()
+            lease = self.leases.get(mac)
+            if lease is not None and lease.expire <= now:
+                del self.leases[mac]
+                self.save_lease(mac)
+
+    def compile_static(self, static_config):
+        '''
+            Returns the bindings of a static config as StaticBindings keyed
+            by packed MAC, skipping (and logging) those which are invalid.
+        '''
+        bindings = dict()
+        for mac, binding in static_config.get('dhcp', {}).get('binding', {}).items():
+            try:
+                packed_mac = bytes.fromhex(mac.replace(':', '').replace('-', ''))
+                if len(packed_mac) != 6:
+                    raise ValueError('not a MAC address')
+                compiled = StaticBinding()
+                if binding.get('ipaddr'):
+                    compiled.ipaddr = socket.inet_ntoa(socket.inet_aton(binding['ipaddr']))
+                if binding.get('subnet'):
+                    compiled.subnet = self.tlv_encode(1, socket.inet_aton(binding['subnet']))
+                if binding.get('router'):
+                    compiled.router = self.tlv_encode(3, socket.inet_aton(binding['router']))
+                if binding.get('dns'):
+                    dns = binding['dns'] if isinstance(binding['dns'], list) else [binding['dns']]
+                    compiled.dns = self.tlv_encode(6, b''.join([socket.inet_aton(i) for i in dns]))
+                if binding.get('rom'):
+                    compiled.rom = self.tlv_encode(67, binding['rom'].encode('ascii') + b'\x00')
+            except (ValueError, TypeError, AttributeError, OSError) as e:
+                self.logger.warning('Ignoring static binding for {0}: {1}'.format(mac, e))
+                continue
+            bindings[packed_mac] = compiled
+        return bindings
+
+    def reload_static(self):
+        '''Reloads the static config if its file changed, checking once a second.'''
+        now = time()
+        if not self.static_config_file or now - self.static_config_checked < 1:
+            return
+        self.static_config_checked = now
+        try:
+            mtime = os.stat(self.static_config_file).st_mtime
+            if mtime == self.static_config_mtime:
+                return
+            self.static_config_mtime = mtime
+            with open(self.static_config_file, 'r') as static_config_file:
+                static_config = json.load(static_config_file)
+        except (IOError, ValueError) as e:
+            self.logger.warning('Failed to reload {0}: {1}'.format(self.static_config_file, e))
+            return
+        if not isinstance(static_config, dict):
+            self.logger.warning('Failed to reload {0}: not a JSON object'.format(self.static_config_file))
+            return
+        bindings = self.compile_static(static_config)
+        if not self.mode_proxy:
+            removed = self.pool.set_static(binding.ipaddr for binding in bindings.values() if binding.ipaddr)
+            if removed:
+                # addresses no longer static go back once nobody's lease holds them
+                holders = dict((lease.ip, mac) for mac, lease in self.leases.items() if lease.ip in removed)
+                for address in removed:
+                    if address in holders:
+                        self.pool.lease(address, holders[address], self.leases[holders[address]].expire)
+                    else:
+                        self.pool.release(address)
+        self.bindings = bindings
+        self.templates = dict()
+        # in place, as the same dict may be shared with the file servers
+        for key in list(self.static_config):
+            if key not in static_config:
+                del self.static_config[key]
+        self.static_config.update(static_config)
+        self.logger.info('Reloaded static config from {0}'.format(self.static_config_file))
+
     def get_namespaced_static(self, path, fallback = {}):
         statics = self.static_config
         for child in path.split('.'):
@@ -148,32 +508,10 @@ class DHCPD:
     def next_ip(self):
         '''
             This method returns the next unleased IP from range;
-            also does lease expiry by overwrite.
+            leases which have expired are put back in the range first.
         '''
-
-        # if we use ints, we don't have to deal with octet overflow
-        # or nested loops (up to 3 with 10/8); convert both to 32-bit integers
-
-        # e.g '192.168.1.1' to 3232235777
-        encode = lambda x: struct.unpack('!I', socket.inet_aton(x))[0]
-
-        # e.g 3232235777 to '192.168.1.1'
-        decode = lambda x: socket.inet_ntoa(struct.pack('!I', x))
-        from_host = encode(self.offer_from)
-        to_host = encode(self.offer_to)
-
-        # pull out already leased IPs
-        leased = [self.leases[i]['ip'] for i in self.leases
-                if self.leases[i]['expire'] > time()]
-
-        # convert to 32-bit int
-        leased = map(encode, leased)
-
-        # loop through, make sure not already leased and not in form X.Y.Z.0
-        for offset in range(to_host - from_host):
-            if (from_host + offset) % 256 and from_host + offset not in leased:
-                return decode(from_host + offset)
-        raise OutOfLeasesError('Ran out of IP addresses to lease!')
+        self.reap()
+        return self.pool.allocate()
 
     def tlv_encode(self, tag, value):
         '''Encode a TLV option.'''
@@ -182,25 +520,56 @@ class DHCPD:
         value = bytes(value)
         return struct.pack('BB', tag, len(value)) + value
 
-    def tlv_parse(self, raw):
-        '''Parse a string of TLV-encoded options.'''
+    def tlv_parse(self, raw, wanted = OPTIONS_USED):
+        '''
+            Parse a string of TLV-encoded options in one pass, keeping those
+            in wanted.
+
+            Raises:
+                MalformedPacketError: if an option runs past the end
+        '''
         ret = {}
-        while(raw):
-            [tag] = struct.unpack('B', raw[0:1])
+        view = memoryview(raw)
+        end = len(view)
+        position = 0
+        while position < end:
+            tag = view[position]
             if tag == 0: # padding
-                raw = raw[1:]
+                position += 1
                 continue
             if tag == 255: # end marker
                 break
-            [length] = struct.unpack('B', raw[1:2])
-            value = raw[2:2 + length]
-            raw = raw[2 + length:]
-            if tag in ret:
-                ret[tag].append(value)
-            else:
-                ret[tag] = [value]
+            start = position + 2
+            if start > end:
+                raise MalformedPacketError('Option {0} is truncated'.format(tag))
+            position = start + view[start - 1]
+            if position > end:
+                raise MalformedPacketError('Option {0} is truncated'.format(tag))
+            if tag in wanted:
+                value = view[start:position].tobytes()
+                if tag in ret:
+                    ret[tag].append(value)
+                else:
+                    ret[tag] = [value]
         return ret
 
+    def parse_request(self, message):
+        '''
+            Returns the client MAC and options of a request.
+
+            Raises:
+                MalformedPacketError: if the request is truncated or malformed
+        '''
+        if len(message) < 240 or message[236:240] != self.magic:
+            raise MalformedPacketError('Not a DHCP packet')
+        with memoryview(message) as view, view[240:] as raw:
+            options = self.tlv_parse(raw)
+        if 53 not in options or len(options[53][0]) != 1:
+            raise MalformedPacketError('No message type')
+        if 93 in options and len(options[93][0]) < 2:
+            raise MalformedPacketError('Client architecture is truncated')
+        return message[28:34], options
+
     def get_mac(self, mac):
         '''
             This method converts the MAC Address from binary to
@@ -209,84 +578,105 @@ class DHCPD:
         return ':'.join(map(lambda x: hex(x)[2:].zfill(2), struct.unpack('BBBBBB', mac))).upper()
 
     def craft_header(self, message):
-        '''This method crafts the DHCP header using parts of the message.'''
-        xid, flags, yiaddr, giaddr, chaddr = struct.unpack('!4x4s2x2s4x4s4x4s16s', message[:44])
-        client_mac = chaddr[:6]
-
+        '''
+            This method crafts the DHCP header into the reply buffer, patching
+            the parts from the message and the offered IP into the template.
+        '''
+        client_mac = message[28:34]
+        reply = self.reply
+        reply[:240] = self.header_template
+        struct.pack_into('4s', reply, 4, message[4:8]) # xid
+        struct.pack_into('16s', reply, 28, message[28:44]) # chaddr
+        if not self.mode_proxy:
+            lease = self.get_lease(client_mac)
+            if lease.ip and lease.expire > time(): # OFFER
+                offer = lease.ip
+            else: # ACK
+                binding = self.bindings.get(client_mac)
+                offer = binding.ipaddr if binding and binding.ipaddr else self.next_ip()
+                lease.ip = offer
+                lease.expire = time() + 86400
+                self.expiring.append((lease.expire, client_mac))
+                self.pool.lease(offer, client_mac, lease.expire)
+                self.save_lease(client_mac)
+                self.logger.info('New Assignment - MAC: {0} -> IP: {1}'.format(self.get_mac(client_mac), lease.ip))
+            struct.pack_into('4s', reply, 16, socket.inet_aton(offer)) # yiaddr
+        return client_mac
+
+    def craft_header_template(self):
+        '''This method crafts the parts of the DHCP header which never change.'''
         # op, htype, hlen, hops, xid
-        response =  struct.pack('!BBBB4s', 2, 1, 6, 0, xid)
+        response =  struct.pack('!BBBB4s', 2, 1, 6, 0, b'\x00' * 4)
         if not self.mode_proxy:
             response += struct.pack('!HHI', 0, 0, 0) # secs, flags, ciaddr
         else:
             response += struct.pack('!HHI', 0, 0x8000, 0)
-        if not self.mode_proxy:
-            if self.leases[client_mac]['ip'] and self.leases[client_mac]['expire'] > time(): # OFFER
-                offer = self.leases[client_mac]['ip']
-            else: # ACK
-                offer = self.get_namespaced_static('dhcp.binding.{0}.ipaddr'.format(self.get_mac(client_mac)))
-                offer = offer if offer else self.next_ip()
-                self.leases[client_mac]['ip'] = offer
-                self.leases[client_mac]['expire'] = time() + 86400
-                self.logger.info('New Assignment - MAC: {0} -> IP: {1}'.format(self.get_mac(client_mac), self.leases[client_mac]['ip']))
-            response += socket.inet_aton(offer) # yiaddr
-        else:
-            response += socket.inet_aton('0.0.0.0')
+        response += socket.inet_aton('0.0.0.0') # yiaddr
         response += socket.inet_aton(self.file_server) # siaddr
         response += socket.inet_aton('0.0.0.0') # giaddr
-        response += chaddr # chaddr
+        response += b'\x00' * 16 # chaddr
 
         # BOOTP legacy pad
         response += b'\x00' * 64 # server name
         if self.mode_proxy:
-            response += self.file_name.encode('ascii')
-            response += b'\x00' * (128 - len(self.file_name))
+            response += self.file_name.encode('ascii')[:128].ljust(128, b'\x00')
         else:
             response += b'\x00' * 128
         response += self.magic # magic section
-        return (client_mac, response)
+        return response
 
     def craft_options(self, opt53, client_mac):
         '''
-            This method crafts the DHCP option fields
+            This method returns the DHCP option fields for a client, from
+            the template for its static binding and boot file.
             opt53:
                 2 - DHCPOFFER
                 5 - DHCPACK
             See RFC2132 9.6 for details.
         '''
-        response = self.tlv_encode(53, struct.pack('!B', opt53)) # message type, OFFER
-        response += self.tlv_encode(54, socket.inet_aton(self.ip)) # DHCP Server
-        if not self.mode_proxy:
-            subnet_mask = self.get_namespaced_static('dhcp.binding.{0}.subnet'.format(self.get_mac(client_mac)), self.subnet_mask)
-            response += self.tlv_encode(1, socket.inet_aton(subnet_mask)) # subnet mask
-            router = self.get_namespaced_static('dhcp.binding.{0}.router'.format(self.get_mac(client_mac)), self.router)
-            response += self.tlv_encode(3, socket.inet_aton(router)) # router
-            dns_server = self.get_namespaced_static('dhcp.binding.{0}.dns'.format(self.get_mac(client_mac)), [self.dns_server])
-            dns_server = b''.join([socket.inet_aton(i) for i in dns_server])
-            response += self.tlv_encode(6, dns_server)
-            response += self.tlv_encode(51, struct.pack('!I', 86400)) # lease time
-
-        # TFTP Server OR HTTP Server; if iPXE, need both
-        response += self.tlv_encode(66, self.file_server)
+        binding = self.bindings.get(client_mac, self.defaults)
 
         # file_name null terminated
-        filename = self.get_namespaced_static('dhcp.binding.{0}.rom'.format(self.get_mac(client_mac)))
-        if not filename:
-            if not self.ipxe or not self.leases[client_mac]['ipxe']:
+        filename = None
+        if not binding.rom:
+            if not self.ipxe or not self.get_lease(client_mac).ipxe:
                 # http://www.syslinux.org/wiki/index.php/PXELINUX#UEFI
-                if 'options' in self.leases[client_mac] and 93 in self.leases[client_mac]['options'] and not self.force_file_name:
-                    [arch] = struct.unpack("!H", self.leases[client_mac]['options'][93][0])
+                if 93 in self.options.get(client_mac, {}) and not self.force_file_name:
+                    [arch] = struct.unpack("!H", self.options[client_mac][93][0][:2])
                     filename = {0: 'pxelinux.0', # BIOS/default
                                 6: 'syslinux.efi32', # EFI IA32
                                 7: 'syslinux.efi64', # EFI BC, x86-64
                                 9: 'syslinux.efi64'  # EFI x86-64
-                                }[arch]
+                                }.get(arch, self.file_name)
                 else:
                     filename = self.file_name
             else:
                 filename = 'chainload.kpxe' # chainload iPXE
                 if opt53 == 5: # ACK
-                    self.leases[client_mac]['ipxe'] = False
-        response += self.tlv_encode(67, filename.encode('ascii') + b'\x00')
+                    self.get_lease(client_mac).ipxe = False
+                    self.save_lease(client_mac)
+
+        template = self.templates.get((opt53, binding, filename))
+        if template is None:
+            template = self.craft_options_template(opt53, binding, filename)
+            self.templates[(opt53, binding, filename)] = template
+        return template
+
+    def craft_options_template(self, opt53, binding, filename):
+        '''This method crafts the DHCP option fields for a static binding (or the defaults) and boot file.'''
+        response = self.tlv_encode(53, struct.pack('!B', opt53)) # message type, OFFER
+        response += self.tlv_encode(54, socket.inet_aton(self.ip)) # DHCP Server
+        if not self.mode_proxy:
+            response += binding.subnet or self.defaults.subnet # subnet mask
+            response += binding.router or self.defaults.router # router
+            response += binding.dns or self.defaults.dns
+            response += self.tlv_encode(51, struct.pack('!I', 86400)) # lease time
+
+        # TFTP Server OR HTTP Server; if iPXE, need both
+        response += self.tlv_encode(66, self.file_server)
+
+        # file_name null terminated
+        response += binding.rom or self.tlv_encode(67, filename.encode('ascii') + b'\x00')
 
         if self.mode_proxy:
             response += self.tlv_encode(60, 'PXEClient')
@@ -294,43 +684,36 @@ class DHCPD:
         response += b'\xff'
         return response
 
+    def send_reply(self, opt53, message):
+        '''This method assembles a reply in the reply buffer and broadcasts it.'''
+        client_mac = self.craft_header(message)
+        options_response = self.craft_options(opt53, client_mac)
+        self.reply[240:240 + len(options_response)] = options_response
+        with memoryview(self.reply) as reply, reply[:240 + len(options_response)] as response:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('{0} - Sending the following'.format('DHCPOFFER' if opt53 == 2 else 'DHCPACK'))
+                self.logger.debug('<--BEGIN HEADER-->')
+                self.logger.debug('{0}'.format(repr(response[:240].tobytes())))
+                self.logger.debug('<--END HEADER-->')
+                self.logger.debug('<--BEGIN OPTIONS-->')
+                self.logger.debug('{0}'.format(repr(options_response)))
+                self.logger.debug('<--END OPTIONS-->')
+                self.logger.debug('<--BEGIN RESPONSE-->')
+                self.logger.debug('{0}'.format(repr(response.tobytes())))
+                self.logger.debug('<--END RESPONSE-->')
+            self.sock.sendto(response, (self.broadcast, 68))
+
     def dhcp_offer(self, message):
         '''This method responds to DHCP discovery with offer.'''
-        client_mac, header_response = self.craft_header(message)
-        options_response = self.craft_options(2, client_mac) # DHCPOFFER
-        response = header_response + options_response
-        self.logger.debug('DHCPOFFER - Sending the following')
-        self.logger.debug('<--BEGIN HEADER-->')
-        self.logger.debug('{0}'.format(repr(header_response)))
-        self.logger.debug('<--END HEADER-->')
-        self.logger.debug('<--BEGIN OPTIONS-->')
-        self.logger.debug('{0}'.format(repr(options_response)))
-        self.logger.debug('<--END OPTIONS-->')
-        self.logger.debug('<--BEGIN RESPONSE-->')
-        self.logger.debug('{0}'.format(repr(response)))
-        self.logger.debug('<--END RESPONSE-->')
-        self.sock.sendto(response, (self.broadcast, 68))
+        self.send_reply(2, message) # DHCPOFFER
 
     def dhcp_ack(self, message):
         '''This method responds to DHCP request with acknowledge.'''
-        client_mac, header_response = self.craft_header(message)
-        options_response = self.craft_options(5, client_mac) # DHCPACK
-        response = header_response + options_response
-        self.logger.debug('DHCPACK - Sending the following')
-        self.logger.debug('<--BEGIN HEADER-->')
-        self.logger.debug('{0}'.format(repr(header_response)))
-        self.logger.debug('<--END HEADER-->')
-        self.logger.debug('<--BEGIN OPTIONS-->')
-        self.logger.debug('{0}'.format(repr(options_response)))
-        self.logger.debug('<--END OPTIONS-->')
-        self.logger.debug('<--BEGIN RESPONSE-->')
-        self.logger.debug('{0}'.format(repr(response)))
-        self.logger.debug('<--END RESPONSE-->')
-        self.sock.sendto(response, (self.broadcast, 68))
+        self.send_reply(5, message) # DHCPACK
 
     def validate_req(self, client_mac):
         # client request is valid only if contains Vendor-Class = PXEClient
-        if self.whitelist and self.get_mac(client_mac) not in self.get_namespaced_static('dhcp.binding'):
+        if self.whitelist and client_mac not in self.bindings:
             self.logger.info('Non-whitelisted client request received from {0}'.format(self.get_mac(client_mac)))
             return False
         if 60 in self.options[client_mac] and 'PXEClient'.encode() in self.options[client_mac][60][0]:
@@ -343,16 +726,25 @@ class DHCPD:
         '''Main listen loop.'''
         while True:
             message, address = self.sock.recvfrom(1024)
-            [client_mac] = struct.unpack('!28x6s', message[:34])
-            self.logger.debug('Received message')
-            self.logger.debug('<--BEGIN MESSAGE-->')
-            self.logger.debug('{0}'.format(repr(message)))
-            self.logger.debug('<--END MESSAGE-->')
-            self.options[client_mac] = self.tlv_parse(message[240:])
-            self.logger.debug('Parsed received options')
-            self.logger.debug('<--BEGIN OPTIONS-->')
-            self.logger.debug('{0}'.format(repr(self.options[client_mac])))
-            self.logger.debug('<--END OPTIONS-->')
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                self.logger.debug('Received message')
+                self.logger.debug('<--BEGIN MESSAGE-->')
+                self.logger.debug('{0}'.format(repr(message)))
+                self.logger.debug('<--END MESSAGE-->')
+            self.reap()
+            self.reload_static()
+            try:
+                client_mac, options = self.parse_request(message)
+            except MalformedPacketError as e:
+                self.logger.debug('Ignoring malformed request from {0}: {1}'.format(address[0], e))
+                continue
+            self.options = {client_mac: options}
+            if debug:
+                self.logger.debug('Parsed received options')
+                self.logger.debug('<--BEGIN OPTIONS-->')
+                self.logger.debug('{0}'.format(repr(self.options[client_mac])))
+                self.logger.debug('<--END OPTIONS-->')
             if not self.validate_req(client_mac):
                 continue
             type = ord(self.options[client_mac][53][0]) # see RFC2131, page 10
@@ -4,8 +4,17 @@ This file contains helper functions used throughout the PyPXE services
 
 '''
 
+import os
 import os.path
+import re
+import stat
+import string
+import hashlib
+import tempfile
+import time
+import threading
 import logging
+from collections import OrderedDict
 
 class PathTraversalException(Exception):
     pass
@@ -35,6 +44,277 @@ def normalize_path(base, filename):
         return normalized
     raise PathTraversalException('Path Traversal detected')
 
+class CachedFile:
+    '''
+        A regular file known to a FileCache. While open, its read-only
+        descriptor is shared by everyone reading the file, so it must be read
+        with os.pread() or mmap rather than through the file position. Call
+        close() once done with it.
+    '''
+    __slots__ = ('cache', 'path', 'key', 'size', 'mtime', 'checked', 'fd', 'users', 'stale')
+
+    def __init__(self, cache, path, key, checked):
+        self.cache = cache
+        self.path = path
+        self.key = key # (inode, size, mtime), None if not a regular file
+        self.size = key[1] if key else None
+        self.mtime = key[2] if key else None
+        self.checked = checked
+        self.fd = None
+        self.users = 0
+        self.stale = False
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self.cache.release(self)
+
+class FileCache:
+    '''
+        Cache of the files served from a netboot directory, shared by the
+        TFTP and HTTP servers so boot storms don't turn into one stat() and
+        open() per request. Lookups, including of files that don't exist,
+        are trusted for `ttl` seconds before the file is checked again; a
+        file whose inode, size or mtime changed gets a new entry and the old
+        descriptor is closed once its last reader is done.
+
+        Args:
+            base (str): The netboot directory
+            ttl (float): Seconds a lookup is trusted for
+            max_entries (int): Lookups to remember
+            max_handles (int): Descriptors to keep open while unused
+    '''
+    def __init__(self, base, ttl = 1, max_entries = 4096, max_handles = 64):
+        self.base = base
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_handles = max_handles
+        self.entries = OrderedDict() # path -> CachedFile
+        self.idle = OrderedDict() # open CachedFiles nobody is reading
+        self.providers = [] # asked for the files not found on disk
+        self.lock = threading.Lock()
+
+    def lookup(self, filename):
+        '''
+            Returns the CachedFile for filename relative to the base, or None
+            if it is not a regular file.
+
+            Raises:
+                PathTraversalException: if filename escapes the base
+        '''
+        path = normalize_path(self.base, filename)
+        with self.lock:
+            entry = self.get(path)
+            return entry if entry.key else None
+
+    def open(self, filename, address = None):
+        '''
+            As lookup(), with the file opened for reading. Files which are
+            not on disk are asked for from the virtual file providers, which
+            may render them for the client at address.
+
+            Raises:
+                PathTraversalException: if filename escapes the base
+                OSError: if the file can't be opened
+        '''
+        path = normalize_path(self.base, filename)
+        with self.lock:
+            entry = self.get(path)
+            if not entry.key:
+                entry = None
+            elif entry.fd is None:
+                entry.fd = os.open(path, os.O_RDONLY)
+                opened = os.fstat(entry.fd)
+                key = (opened.st_ino, opened.st_size, opened.st_mtime)
+                if key != entry.key:
+                    # replaced since we looked; nobody else has this entry open
+                    entry.key, entry.size, entry.mtime = key, key[1], key[2]
+            if entry is not None:
+                self.idle.pop(entry, None)
+                entry.users += 1
+                return entry
+        relative = os.path.relpath(path, os.path.abspath(self.base))
+        for provider in self.providers:
+            entry = provider.open(self, relative, address)
+            if entry is not None:
+                return entry
+        return None
+
+    def release(self, entry):
+        '''Called by CachedFile.close(), keeps the descriptor for reuse.'''
+        with self.lock:
+            entry.users -= 1
+            if entry.users:
+                return
+            if entry.stale:
+                os.close(entry.fd)
+                entry.fd = None
+                return
+            self.idle[entry] = True
+            while len(self.idle) > self.max_handles:
+                old = self.idle.popitem(last = False)[0]
+                os.close(old.fd)
+                old.fd = None
+
+    def get(self, path):
+        '''Returns the current entry for path; the lock must be held.'''
+        now = time.time()
+        entry = self.entries.get(path)
+        if entry is not None and now - entry.checked < self.ttl:
+            self.entries.move_to_end(path)
+            return entry
+        try:
+            found = os.stat(path)
+            key = (found.st_ino, found.st_size, found.st_mtime) if stat.S_ISREG(found.st_mode) else None
+        except OSError:
+            key = None
+        if entry is not None:
+            if entry.key == key:
+                entry.checked = now
+                self.entries.move_to_end(path)
+                return entry
+            self.discard(entry)
+        entry = CachedFile(self, path, key, now)
+        self.entries[path] = entry
+        while len(self.entries) > self.max_entries:
+            self.discard(self.entries.popitem(last = False)[1])
+        return entry
+
+    def discard(self, entry):
+        '''Forgets an entry, closing it unless in use; the lock must be held.'''
+        self.entries.pop(entry.path, None)
+        entry.stale = True
+        if entry.fd is not None and not entry.users:
+            self.idle.pop(entry, None)
+            os.close(entry.fd)
+            entry.fd = None
+
+class TemplateFiles:
+    '''
+        Virtual file provider for FileCache, rendering boot configuration
+        files for each client from templates instead of keeping a generated
+        file per client in the netboot directory.
+
+        `templates` maps the names of the virtual files to templates in the
+        netboot directory. Names may contain a {mac} or {ip} placeholder, as
+        in pxelinux.cfg/01-{mac}. Templates use string.Template syntax and
+        are given $mac, $ip, $client_ip and every setting of the client's
+        binding in the static config, such as $ipaddr and $rom; anything
+        else, like ${net0/mac} in iPXE scripts, is left as is. Renders are
+        cached by their inputs, up to max_renders of them.
+    '''
+    placeholders = {'mac': r'(?P<mac>[0-9a-fA-F]{2}(?:[-:]?[0-9a-fA-F]{2}){5})',
+                    'ip': r'(?P<ip>\d{1,3}(?:\.\d{1,3}){3})'}
+
+    def __init__(self, templates, static_config = {}, max_renders = 1024):
+        self.patterns = []
+        for name, template in templates.items():
+            pattern = re.escape(name)
+            for placeholder, expression in self.placeholders.items():
+                pattern = pattern.replace(re.escape('{' + placeholder + '}'), expression)
+            self.patterns.append((re.compile(pattern + '$'), template))
+        # keyed by MAC in the AA:BB:CC:DD:EE:FF form, whatever form the
+        # config uses, as DHCPD.compile_static accepts any case and - too
+        self.bindings = dict()
+        for mac, binding in static_config.get('dhcp', {}).get('binding', {}).items():
+            mac = self.normalize_mac(mac)
+            if mac:
+                self.bindings[mac] = binding
+        self.max_renders = max_renders
+        self.renders = OrderedDict() # inputs -> CachedFile
+        self.lock = threading.Lock()
+
+    def open(self, files, filename, address):
+        '''Returns filename rendered for the client at address, or None.'''
+        for pattern, template in self.patterns:
+            match = pattern.match(filename)
+            if match:
+                break
+        else:
+            return None
+        client_ip = address[0] if address else ''
+        mac = self.normalize_mac(match.groupdict().get('mac') or '')
+        ip = match.groupdict().get('ip') or client_ip
+        binding = self.bindings.get(mac, {}) if mac else {}
+        if not mac:
+            for mac, binding in self.bindings.items():
+                if binding.get('ipaddr') == ip:
+                    break
+            else:
+                mac, binding = '', {}
+        variables = dict((name, ','.join(value) if isinstance(value, list) else str(value))
+                         for name, value in binding.items())
+        variables.update(mac = mac, ip = ip, client_ip = client_ip)
+        source = files.lookup(template)
+        if source is None:
+            return None
+        key = (filename, source.path, source.key, tuple(sorted(variables.items())))
+        with self.lock:
+            entry = self.renders.get(key)
+            if entry is None:
+                entry = self.render(files, filename, source, variables)
+                self.renders[key] = entry
+                while len(self.renders) > self.max_renders:
+                    old = self.renders.popitem(last = False)[1]
+                    old.stale = True
+                    if not old.users:
+                        os.close(old.fd)
+            else:
+                self.renders.move_to_end(key)
+            entry.users += 1
+            return entry
+
+    @staticmethod
+    def normalize_mac(mac):
+        '''Returns mac as AA:BB:CC:DD:EE:FF, or None if it is not a MAC address.'''
+        try:
+            packed_mac = bytes.fromhex(mac.replace(':', '').replace('-', ''))
+        except (ValueError, AttributeError):
+            return None
+        if len(packed_mac) != 6:
+            return None
+        return ':'.join('{0:02X}'.format(octet) for octet in packed_mac)
+
+    def render(self, files, filename, source, variables):
+        '''Renders a template into an anonymous file; the lock must be held.'''
+        with open(source.path, 'r') as template:
+            data = string.Template(template.read()).safe_substitute(variables).encode('utf-8')
+        fd = anonymous_file(os.path.basename(filename), data)
+        # named after the content, so caches keyed by path never mix renders
+        path = '{0}#{1}'.format(normalize_path(files.base, filename), hashlib.sha1(data).hexdigest()[:12])
+        entry = CachedFile(self, path, (None, len(data), source.mtime), time.time())
+        entry.fd = fd
+        return entry
+
+    def release(self, entry):
+        '''Called by CachedFile.close().'''
+        with self.lock:
+            entry.users -= 1
+            if not entry.users and entry.stale:
+                os.close(entry.fd)
+
+def anonymous_file(name, data):
+    '''
+        Returns a descriptor of a file holding data which has no name on
+        disk, so it can be read, mapped and sent like a regular file.
+    '''
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create(name)
+    else:
+        with tempfile.TemporaryFile() as temporary:
+            fd = os.dup(temporary.fileno())
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+    return fd
+
+file_caches = {}
+
+def get_file_cache(base):
+    '''Returns the FileCache shared by every server using base.'''
+    return file_caches.setdefault(os.path.abspath(base), FileCache(base))
+
 def get_child_logger(logger, name):
     '''
         Get a descendant of an existing Logger.
@@ -49,3 +329,17 @@ def get_child_logger(logger, name):
             Logger: new Logger with `name` appended
     '''
     return logging.getLogger("{0}.{1}".format(logger.name, name))
+
+class ContextAdapter(logging.LoggerAdapter):
+    '''
+        LoggerAdapter which prefixes every message with its context, such
+        as a client address.
+
+        Short-lived objects log through one of these rather than a Logger of
+        their own, as Loggers are never freed once created.
+    '''
+    def __init__(self, logger, context):
+        logging.LoggerAdapter.__init__(self, logger, {'context': context})
+
+    def process(self, msg, kwargs):
+        return '{0} {1}'.format(self.extra['context'], msg), kwargs
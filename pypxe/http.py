@@ -7,10 +7,95 @@ This file contains classes and functions that implement the PyPXE HTTP service
 import socket
 import struct
 import os
+import errno
+import zlib
+import gzip
+import time
+import heapq
+import itertools
 import threading
+import selectors
 import logging
+import email.utils
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pypxe import helpers
 
+class Connection:
+    '''A client connection, with what it has sent of its next request.'''
+    __slots__ = ('sock', 'address', 'buffer', 'deadline', 'body')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = b''
+        self.deadline = None # when it is closed unless the request arrives
+        self.body = False # the head has arrived, waiting for the body
+
+class GzipCache:
+    '''
+        Size-bounded LRU cache of files gzipped on the fly, kept in anonymous
+        files so they are sent like any other. Files which don't compress
+        well are remembered too, and served as they are; they take no space,
+        so the number of entries is bounded as well.
+    '''
+    def __init__(self, max_size, max_entries = 4096):
+        self.max_size = max_size # bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self.entries = OrderedDict() # (path, key) -> CachedFile or None
+        self.lock = threading.Lock()
+
+    def open(self, handle):
+        '''Returns a gzipped copy of an opened file, or None.'''
+        key = (handle.path, handle.key)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                entry = self.entries[key]
+                if entry is not None:
+                    entry.users += 1
+                return entry
+        # compress without holding up everyone else
+        data = b''
+        while len(data) < handle.size:
+            chunk = os.pread(handle.fileno(), handle.size - len(data), len(data))
+            if not chunk:
+                break
+            data += chunk
+        data = gzip.compress(data, mtime = 0)
+        entry = None
+        if len(data) < handle.size * 0.9:
+            entry = helpers.CachedFile(self, handle.path + '.gz', (None, len(data), handle.mtime), time.time())
+            entry.fd = helpers.anonymous_file(os.path.basename(handle.path) + '.gz', data)
+            entry.users = 1
+        with self.lock:
+            if key in self.entries:
+                # compressed by someone else meanwhile, keep theirs
+                if entry is not None:
+                    os.close(entry.fd)
+                entry = self.entries[key]
+                if entry is not None:
+                    entry.users += 1
+                return entry
+            self.entries[key] = entry
+            self.size += entry.size if entry is not None else 0
+            while self.size > self.max_size or len(self.entries) > self.max_entries:
+                old = self.entries.popitem(last = False)[1]
+                if old is not None:
+                    self.size -= old.size
+                    old.stale = True
+                    if not old.users:
+                        os.close(old.fd)
+            return entry
+
+    def release(self, entry):
+        '''Called by CachedFile.close().'''
+        with self.lock:
+            entry.users -= 1
+            if not entry.users and entry.stale:
+                os.close(entry.fd)
+
 class HTTPD:
     '''
         This class implements a HTTP Server, limited to GET and HEAD,
@@ -24,6 +109,20 @@ class HTTPD:
         self.mode_verbose = server_settings.get('mode_verbose', False) # verbose mode
         self.mode_debug = server_settings.get('mode_debug', False) # debug mode
         self.logger =  server_settings.get('logger', None)
+        self.keepalive_timeout = server_settings.get('keepalive_timeout', 15) # seconds
+        self.header_timeout = server_settings.get('header_timeout', 10) # seconds
+        self.body_timeout = server_settings.get('body_timeout', 10) # seconds
+        self.send_timeout = server_settings.get('send_timeout', 30) # seconds
+        self.min_send_rate = int(server_settings.get('min_send_rate', 1024)) # bytes per second
+        self.max_connections_per_ip = int(server_settings.get('max_connections_per_ip', 64))
+        self.max_header_size = int(server_settings.get('max_header_size', 8192))
+        self.backlog = int(server_settings.get('backlog', 128))
+        self.max_connections = int(server_settings.get('max_connections', 1024))
+        self.threads = int(server_settings.get('threads', 16))
+        self.compress = server_settings.get('compress', False)
+        self.compress_max_size = int(server_settings.get('compress_max_size', 1024 * 1024))
+        self.compress_cache_size = int(server_settings.get('compress_cache_size', 16 * 1024 * 1024))
+        self.gzip_cache = GzipCache(self.compress_cache_size) if self.compress else None
 
         # setup logger
         if self.logger == None:
@@ -40,29 +139,253 @@ class HTTPD:
         else:
             self.logger.setLevel(logging.WARN)
 
+        self.files = helpers.get_file_cache(self.netboot_directory)
+        for provider in server_settings.get('virtual_files', []):
+            if provider not in self.files.providers:
+                self.files.providers.append(provider)
+
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.ip, self.port))
-        self.sock.listen(1)
+        self.sock.listen(self.backlog)
+        self.sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.connections = set()
+        self.per_ip = {} # client IP -> open connections
+        self.timers = [] # heap of (deadline, sequence, connection)
+        self.timer_sequence = itertools.count()
+        self.accepting = False
 
         self.logger.debug('NOTICE: HTTP server started in debug mode. HTTP server is using the following:')
         self.logger.info('Server IP: {0}'.format(self.ip))
         self.logger.info('Server Port: {0}'.format(self.port))
         self.logger.info('Network Boot Directory: {0}'.format(self.netboot_directory))
 
-    def handle_request(self, connection, addr):
-        '''This method handles HTTP request.'''
-        request = connection.recv(1024)
-        self.logger.debug('Received message from {addr}'.format(addr = repr(addr)))
+    def accept(self):
+        '''Accepts the waiting connections, up to max_connections.'''
+        while len(self.connections) < self.max_connections:
+            try:
+                sock, address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                self.logger.error('Failed to accept a connection: {0}'.format(error))
+                if not self.connections:
+                    return
+                break # e.g. out of descriptors, try again once one closes
+            if self.max_connections_per_ip and self.per_ip.get(address[0], 0) >= self.max_connections_per_ip:
+                self.logger.debug('Too many connections from {0}, refusing'.format(address[0]))
+                sock.close()
+                continue
+            sock.setblocking(False)
+            connection = Connection(sock, address)
+            self.connections.add(connection)
+            self.per_ip[address[0]] = self.per_ip.get(address[0], 0) + 1
+            self.wait(connection)
+        # at the limit, leave the rest in the backlog
+        self.selector.unregister(self.sock)
+        self.accepting = False
+
+    def wait(self, connection):
+        '''Waits for the next request on a connection.'''
+        self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+        self.set_deadline(connection, self.keepalive_timeout)
+        # it may have been pipelined
+        if connection.buffer:
+            self.process(connection)
+
+    def close(self, connection):
+        '''Closes a connection the event loop is responsible for.'''
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass # being served, or never registered
+        connection.deadline = None
+        self.connections.discard(connection)
+        ip = connection.address[0]
+        self.per_ip[ip] -= 1
+        if not self.per_ip[ip]:
+            del self.per_ip[ip]
+        connection.sock.close()
+        if not self.accepting:
+            self.selector.register(self.sock, selectors.EVENT_READ)
+            self.accepting = True
+
+    def read(self, connection):
+        '''Reads what a client sent, serving it if it completes a request.'''
+        try:
+            data = connection.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close(connection)
+            return
+        if not connection.buffer:
+            # a new request, which has header_timeout to arrive
+            self.set_deadline(connection, self.header_timeout)
+        connection.buffer += data
+        self.process(connection)
+
+    def set_deadline(self, connection, timeout):
+        '''Closes the connection in timeout seconds, unless a request arrives.'''
+        connection.deadline = time.time() + timeout
+        heapq.heappush(self.timers, (connection.deadline, next(self.timer_sequence), connection))
+
+    def process(self, connection):
+        '''Hands the next request on a connection to the threads, if it is all here.'''
+        request = self.next_request(connection)
+        if request is None:
+            if not connection.body and b'\r\n\r\n' in connection.buffer:
+                connection.body = True
+                self.set_deadline(connection, self.body_timeout)
+            return
+        self.selector.unregister(connection.sock)
+        connection.deadline = None
+        connection.body = False
+        if isinstance(request, str):
+            self.pool.submit(self.serve, connection, self.send_status, connection.sock, connection.address, request, '', False)
+        else:
+            self.pool.submit(self.serve, connection, self.handle_request, connection.sock, connection.address, *request)
+
+    def next_request(self, connection):
+        '''
+            Takes the next whole request off a connection's buffer, returning
+            its method, target, version and headers, None if it has not all
+            arrived yet, or the status to fail with if it is malformed.
+        '''
+        head, found, rest = connection.buffer.partition(b'\r\n\r\n')
+        if not found:
+            if len(connection.buffer) > self.max_header_size:
+                return '431 Request Header Fields Too Large'
+            return None
+        request = self.parse_request(head)
+        if request is None:
+            return '400 Bad Request'
+        method, target, version, headers = request
+        # we serve no methods with a body, but must not take one for the next request
+        if 'transfer-encoding' in headers:
+            return '501 Not Implemented'
+        length = int(headers.get('content-length', 0))
+        if length > 65536:
+            return '413 Payload Too Large'
+        if len(rest) < length:
+            return None
+        connection.buffer = rest[length:]
+        self.logger.debug('Received message from {addr}'.format(addr = repr(connection.address)))
         self.logger.debug('<--BEGIN MESSAGE-->')
-        self.logger.debug('{0}'.format(repr(request)))
+        self.logger.debug('{0}'.format(repr(head)))
+        self.logger.debug('<--END MESSAGE-->')
+        return request
+
+    def serve(self, connection, handler, *args):
+        '''
+            Runs a request handler in one of the threads, where it may block,
+            then passes the connection back to the event loop.
+        '''
+        try:
+            # sends which stall for send_timeout fail with socket.timeout
+            connection.sock.settimeout(self.send_timeout)
+            keep_alive = handler(*args)
+            connection.sock.setblocking(False)
+        except OSError:
+            keep_alive = False # gone, or too slow
+        except:
+            self.logger.exception('Error while serving {0}'.format(connection.address))
+            keep_alive = False
+        self.done.append((connection, keep_alive))
+        try:
+            self.wakeup[1].send(b'\x00')
+        except (BlockingIOError, InterruptedError):
+            pass # the loop has plenty of wakeups pending already
+
+    def served(self):
+        '''Takes back the connections the threads are done with.'''
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.done:
+            connection, keep_alive = self.done.popleft()
+            if keep_alive:
+                self.wait(connection)
+            else:
+                self.close(connection)
+
+    def expire(self):
+        '''
+            Closes the connections which have been idle for too long, or too
+            slow sending a request, and returns how long until the next
+            deadline, or None.
+        '''
+        now = time.time()
+        while self.timers:
+            deadline, sequence, connection = self.timers[0]
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self.timers)
+            if connection.deadline == deadline:
+                self.logger.debug('Closing idle or slow connection from {0}'.format(connection.address))
+                self.close(connection)
+        return None
+
+    def parse_request(self, head):
+        '''
+            Splits a request head into its method, target, version and a
+            dict of headers with lowercase names, or returns None if it is
+            malformed.
+        '''
+        try:
+            lines = head.decode('iso-8859-1').split('\r\n')
+            method, target, version = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            if int(headers.get('content-length', 0)) < 0:
+                return None
+        except ValueError:
+            return None
+        if not version.startswith('HTTP/1.'):
+            return None
+        return method, target, version, headers
+
+    def keep_alive(self, version, headers):
+        '''Determines if the client wants the connection kept open.'''
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    def send_status(self, connection, addr, status, target, keep_alive, headers = ''):
+        '''Sends an error status with no body.'''
+        response = 'HTTP/1.1 {0}\r\n'.format(status)
+        response += headers
+        response += 'Content-Length: 0\r\n'
+        response += 'Connection: {0}\r\n'.format('keep-alive' if keep_alive else 'close')
+        response += '\r\n'
+        connection.sendall(response.encode('ascii'))
+        self.logger.warn('Sending {status} to {addr[0]}:{addr[1]} for {target}'.format(status = status, target = target, addr = addr))
+        self.logger.debug('Sending message to {0}'.format(repr(addr)))
+        self.logger.debug('<--BEING MESSAGE-->')
+        self.logger.debug('{0}'.format(repr(response)))
         self.logger.debug('<--END MESSAGE-->')
-        method, target, version = request.decode('ascii').split('\r\n')[0].split(' ')
+
+    def handle_request(self, connection, addr, method, target, version, headers):
+        '''
+            This method handles a HTTP request. Returns True if the
+            connection is to be kept open for another one.
+        '''
+        keep_alive = self.keep_alive(version, headers)
         target = target.lstrip('/')
+        handle = None
         try:
             self.logger.debug("Netboot: {0}, Target: {1}".format(self.netboot_directory, target))
-            target = helpers.normalize_path(self.netboot_directory, target)
-            if not os.path.lexists(target) or not os.path.isfile(target):
+            handle = self.files.open(target, addr)
+            if handle is None:
                 status = '404 Not Found'
             elif method not in ('GET', 'HEAD'):
                 status = '501 Not Implemented'
@@ -70,39 +393,244 @@ class HTTPD:
                 status = '200 OK'
         except helpers.PathTraversalException:
             status = '403 Forbidden'
-        response = 'HTTP/1.1 {0}\r\n'.format(status)
+        except OSError:
+            status = '403 Forbidden' # exists, but we can't read it
         if status[:3] != '200': # fail out
-            connection.send(response.encode('ascii'))
-            connection.close()
-            self.logger.warn('Sending {status} to {addr[0]}:{addr[1]} for {target}'.format(status = status, target = target, addr = addr))
-            self.logger.debug('Sending message to {0}'.format(repr(addr)))
-            self.logger.debug('<--BEING MESSAGE-->')
-            self.logger.debug('{0}'.format(repr(response)))
-            self.logger.debug('<--END MESSAGE-->')
-            return
-        response += 'Content-Length: {0}\r\n'.format(os.path.getsize(target))
-        response += '\r\n'
-        if method == 'HEAD':
-            connection.send(response.encode('ascii'))
-            connection.close()
-            self.logger.debug('Sending message to {0}'.format(repr(addr)))
-            self.logger.debug('<--BEING MESSAGE-->')
-            self.logger.debug('{0}'.format(repr(response)))
-            self.logger.debug('<--END MESSAGE-->')
-            return
-        connection.send(response.encode('ascii'))
-        with open(target, 'rb') as handle:
-            while True:
-                data = handle.read(8192)
-                if not data: break
-                connection.send(data)
-        connection.close()
-        self.logger.info('File Sent - {target} -> {addr[0]}:{addr[1]}'.format(target = target, addr = addr))
+            if handle is not None:
+                handle.close()
+            self.send_status(connection, addr, status, target, keep_alive)
+            return keep_alive
+        # from here on the handle is ours to close, whatever happens
+        try:
+            encoding = ''
+            if self.accepts_gzip(headers):
+                gzipped = self.gzipped(target, handle, addr)
+                if gzipped is not None:
+                    handle, original = gzipped, handle
+                    original.close()
+                    encoding = 'Content-Encoding: gzip\r\n'
+            target = handle.path
+            connection_header = 'Connection: {0}\r\n'.format('keep-alive' if keep_alive else 'close')
+            etag = '"{0:x}-{1:x}-{2:x}"'.format(zlib.crc32(handle.path.encode('utf-8')), handle.size, int(handle.mtime * 1000000))
+            last_modified = email.utils.formatdate(handle.mtime, usegmt = True)
+            validators = 'ETag: {0}\r\nLast-Modified: {1}\r\n'.format(etag, last_modified)
+            validators += 'Vary: Accept-Encoding\r\n'
+            if self.not_modified(headers, etag, handle.mtime):
+                response = 'HTTP/1.1 304 Not Modified\r\n' + validators + connection_header + '\r\n'
+                connection.sendall(response.encode('ascii'))
+                self.logger.debug('Sending message to {0}'.format(repr(addr)))
+                self.logger.debug('<--BEING MESSAGE-->')
+                self.logger.debug('{0}'.format(repr(response)))
+                self.logger.debug('<--END MESSAGE-->')
+                return keep_alive
+            ranges = None
+            if method == 'GET':
+                ranges = self.parse_ranges(headers, handle.size, etag, last_modified)
+            if ranges == []:
+                self.send_status(connection, addr, '416 Range Not Satisfiable', target, keep_alive,
+                                 'Content-Range: bytes */{0}\r\n'.format(handle.size))
+                return keep_alive
+            # the body as (part header, offset, count) pieces
+            if ranges is None:
+                response = 'HTTP/1.1 200 OK\r\n'
+                parts = [('', 0, handle.size)]
+            elif len(ranges) == 1:
+                first, last = ranges[0]
+                response = 'HTTP/1.1 206 Partial Content\r\n'
+                response += 'Content-Range: bytes {0}-{1}/{2}\r\n'.format(first, last, handle.size)
+                parts = [('', first, last - first + 1)]
+            else:
+                boundary = etag.strip('"')
+                response = 'HTTP/1.1 206 Partial Content\r\n'
+                response += 'Content-Type: multipart/byteranges; boundary={0}\r\n'.format(boundary)
+                parts = []
+                for first, last in ranges:
+                    part = '\r\n--{0}\r\n'.format(boundary)
+                    part += 'Content-Type: application/octet-stream\r\n'
+                    part += 'Content-Range: bytes {0}-{1}/{2}\r\n\r\n'.format(first, last, handle.size)
+                    parts.append((part, first, last - first + 1))
+                parts.append(('\r\n--{0}--\r\n'.format(boundary), 0, 0))
+            response += 'Content-Length: {0}\r\n'.format(sum(len(part) + count for part, offset, count in parts))
+            response += 'Accept-Ranges: bytes\r\n'
+            response += encoding
+            response += validators
+            response += connection_header
+            response += '\r\n'
+            if method == 'HEAD':
+                connection.sendall(response.encode('ascii'))
+                self.logger.debug('Sending message to {0}'.format(repr(addr)))
+                self.logger.debug('<--BEING MESSAGE-->')
+                self.logger.debug('{0}'.format(repr(response)))
+                self.logger.debug('<--END MESSAGE-->')
+                return keep_alive
+            connection.sendall(response.encode('ascii'))
+            complete = True
+            for part, offset, count in parts:
+                if part:
+                    connection.sendall(part.encode('ascii'))
+                if count and complete:
+                    complete = self.send_file(connection, handle, offset, count)
+            self.logger.info('File Sent - {target} -> {addr[0]}:{addr[1]}'.format(target = target, addr = addr))
+            # the client can only tell a truncated body from its length if we close
+            return keep_alive and complete
+        finally:
+            handle.close()
+
+    def accepts_gzip(self, headers):
+        '''Determines if the client accepts gzip content coding.'''
+        qualities = {}
+        for coding in headers.get('accept-encoding', '').split(','):
+            name, semicolon, parameters = coding.partition(';')
+            quality = 1.0
+            for parameter in parameters.split(';'):
+                parameter = parameter.strip()
+                if parameter.startswith('q='):
+                    try:
+                        quality = float(parameter[2:])
+                    except ValueError:
+                        quality = 0
+            qualities[name.strip().lower()] = quality
+        return qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0))) > 0
+
+    def gzipped(self, target, handle, addr):
+        '''
+            Returns a gzipped version of an opened file: a .gz file next to
+            it which is at least as new, or one compressed on the fly if
+            enabled; otherwise None.
+        '''
+        try:
+            sidecar = self.files.open(target + '.gz', addr)
+        except (helpers.PathTraversalException, OSError):
+            sidecar = None
+        if sidecar is not None:
+            if sidecar.mtime >= handle.mtime:
+                return sidecar
+            sidecar.close()
+        if self.gzip_cache and handle.size <= self.compress_max_size:
+            return self.gzip_cache.open(handle)
+        return None
+
+    def not_modified(self, headers, etag, mtime):
+        '''Determines if a conditional request can be answered with 304.'''
+        if 'if-none-match' in headers:
+            tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            return etag in tags or '*' in tags
+        if 'if-modified-since' in headers:
+            try:
+                since = email.utils.parsedate_to_datetime(headers['if-modified-since']).timestamp()
+            except (TypeError, ValueError, IndexError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def parse_ranges(self, headers, size, etag, last_modified):
+        '''
+            Returns the byte ranges a client asked for as (first, last)
+            pairs, [] if none of them can be satisfied, or None if the
+            whole file is to be sent.
+        '''
+        value = headers.get('range', '')
+        if not value.startswith('bytes='):
+            return None
+        if headers.get('if-range', etag) not in (etag, last_modified):
+            return None # changed since the client got the start of it
+        ranges = []
+        for spec in value[6:].split(','):
+            first, dash, last = spec.strip().partition('-')
+            try:
+                if not dash:
+                    return None
+                if first:
+                    first = int(first)
+                    if last and int(last) < first:
+                        return None
+                    last = int(last) if last else size - 1
+                else:
+                    # the last bytes of the file
+                    first, last = max(0, size - int(last)), size - 1
+                    if last < first:
+                        continue
+            except ValueError:
+                return None
+            if first < size:
+                ranges.append((first, min(last, size - 1)))
+        if len(ranges) > 16:
+            return None # not worth serving piecemeal
+        return ranges
+
+    def send_file(self, connection, handle, offset, count):
+        '''
+            Sends count bytes of a file from offset, straight from the page
+            cache with sendfile() where we can. Returns False if the file
+            turned out to be shorter.
+
+            Raises:
+                socket.timeout: if the client stops reading for send_timeout,
+                                or reads slower than min_send_rate after it
+        '''
+        end = offset + count
+        start = (time.time(), offset)
+        if hasattr(os, 'sendfile'):
+            writable = None
+            try:
+                while offset < end:
+                    try:
+                        sent = os.sendfile(connection.fileno(), handle.fileno(), offset, end - offset)
+                    except BlockingIOError:
+                        # the socket has a timeout, so sendfile() doesn't block
+                        if writable is None:
+                            writable = selectors.DefaultSelector()
+                            writable.register(connection, selectors.EVENT_WRITE)
+                        if not writable.select(self.send_timeout):
+                            raise socket.timeout('Client stopped reading')
+                        continue
+                    if not sent:
+                        return False # the file was truncated under us
+                    offset += sent
+                    self.check_send_rate(start, offset)
+                return True
+            except OSError as error:
+                if error.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                # not for this kind of file, copy the rest ourselves
+            finally:
+                if writable is not None:
+                    writable.close()
+        while offset < end:
+            # the descriptor is shared, so read at our own offset
+            data = os.pread(handle.fileno(), min(65536, end - offset), offset)
+            if not data:
+                return False
+            connection.sendall(data)
+            offset += len(data)
+            self.check_send_rate(start, offset)
+        return True
+
+    def check_send_rate(self, start, offset):
+        '''Gives up on clients reading slower than min_send_rate.'''
+        elapsed = time.time() - start[0]
+        if self.min_send_rate and elapsed > self.send_timeout and offset - start[1] < self.min_send_rate * elapsed:
+            raise socket.timeout('Client reading too slowly')
 
     def listen(self):
-        '''This method is the main loop that listens for requests.'''
+        '''
+            This method is the main loop that listens for requests. Waiting
+            for requests happens here, serving them on a pool of threads.
+        '''
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.done = deque()
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.accepting = True
         while True:
-            conn, addr = self.sock.accept()
-            client = threading.Thread(target = self.handle_request, args = (conn, addr))
-            client.daemon = True;
-            client.start()
+            for key, mask in self.selector.select(self.expire()):
+                if key.fileobj == self.sock:
+                    self.accept()
+                elif key.fileobj == self.wakeup[0]:
+                    self.served()
+                else:
+                    self.read(key.data)
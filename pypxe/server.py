@@ -41,6 +41,8 @@ SETTINGS = {'NETBOOT_DIR':'netboot',
             'SYSLOG_PORT':514,
             'TFTP_PORT':69,
             'TFTP_SERVER_IP':'0.0.0.0',
+            'TFTP_WORKERS':1,
+            'VIRTUAL_FILES':'',
             'USE_IPXE':False,
             'USE_HTTP':False,
             'USE_TFTP':True,
@@ -78,7 +80,8 @@ def parse_cli_arguments():
     parser.add_argument('--dump-config', action = 'store_true', dest = 'DUMP_CONFIG', help = 'Dump the default configuration as a valid input file')
     parser.add_argument('--dump-config-merged', action = 'store_true', dest = 'DUMP_CONFIG_MERGED', help = 'Like --dump-config, but also merge in CLI options')
     parser.add_argument('--static-config', action = 'store', dest = 'STATIC_CONFIG', help = 'Configure leases from a json file rather than the command line', default = SETTINGS['STATIC_CONFIG'])
-    parser.add_argument('--save-leases', action = 'store', dest = 'LEASES_FILE', help = 'Save all DHCP leases on exit or SIGHUP. Will load from this file on start', default = SETTINGS['LEASES_FILE'])
+    parser.add_argument('--virtual-files', action = 'store', dest = 'VIRTUAL_FILES', help = 'Render per-client files from templates, as mapped in a json file', default = SETTINGS['VIRTUAL_FILES'])
+    parser.add_argument('--save-leases', action = 'store', dest = 'LEASES_FILE', help = 'Save all DHCP leases as they are made. Will load from this file on start', default = SETTINGS['LEASES_FILE'])
     parser.add_argument('--syslog', action = 'store', dest = 'SYSLOG_SERVER', help = 'Syslog server', default = SETTINGS['SYSLOG_SERVER'])
     parser.add_argument('--syslog-port', action = 'store', dest = 'SYSLOG_PORT', help = 'Syslog server port', default = SETTINGS['SYSLOG_PORT'])
 
@@ -122,6 +125,7 @@ def parse_cli_arguments():
     tftp_group = parser.add_argument_group(title = 'TFTP', description = 'Arguments relevant to the TFTP server')
     tftp_group.add_argument('--tftp-port', action = 'store', dest = 'TFTP_PORT', help = 'TFTP Server Port', default = SETTINGS['TFTP_PORT'])
     tftp_group.add_argument('--tftp-server-ip', action = 'store', dest = 'TFTP_SERVER_IP', help = 'TFTP Server IP', default = SETTINGS['TFTP_SERVER_IP'])
+    tftp_group.add_argument('--tftp-workers', action = 'store', dest = 'TFTP_WORKERS', help = 'Number of TFTP worker processes sharing the port', default = SETTINGS['TFTP_WORKERS'])
 
     return parser.parse_args()
 
@@ -137,6 +141,7 @@ def do_verbose(service):
 
 def main():
     global SETTINGS, args
+    tftp_server = None
     try:
         # configure
         args = parse_cli_arguments()
@@ -212,10 +217,44 @@ def main():
             # cow implies write
             args.NBD_WRITE = True
 
+        def load_json_config(filename):
+            result = ['', dict()]
+
+            try:
+                json_config = io.open(filename, 'r')
+            except IOError:
+                result[0] = "Failed to open {0}".format(filename)
+                return result
+
+            try:
+                result[1] = json.load(json_config)
+                json_config.close()
+            except ValueError:
+                result[0] = "{0} does not contain valid json".format(filename)
+                return result
+
+            return result
+
+        if args.STATIC_CONFIG:
+            message, loaded_statics = load_json_config(args.STATIC_CONFIG)
+            if message:
+                sys.exit(message)
+        else:
+            loaded_statics = dict()
+
+        # per-client files rendered from templates for TFTP and HTTP
+        virtual_files = []
+        if args.VIRTUAL_FILES:
+            message, loaded_templates = load_json_config(args.VIRTUAL_FILES)
+            if message:
+                sys.exit(message)
+            virtual_files.append(helpers.TemplateFiles(loaded_templates, static_config = loaded_statics))
+
         # make a list of running threads for each service
         running_services = []
 
-        # configure/start TFTP server
+        # configure/start TFTP server; first, as its worker processes are
+        # forked while no other thread is running
         if args.USE_TFTP:
 
             # setup TFTP logger
@@ -229,7 +268,9 @@ def main():
                 logger = tftp_logger,
                 netboot_directory = args.NETBOOT_DIR,
                 port = args.TFTP_PORT,
-                ip = args.TFTP_SERVER_IP)
+                ip = args.TFTP_SERVER_IP,
+                workers = args.TFTP_WORKERS,
+                virtual_files = virtual_files)
             tftpd = threading.Thread(target = tftp_server.listen)
             tftpd.daemon = True
             tftpd.start()
@@ -245,31 +286,6 @@ def main():
                 if signum == signal.SIGINT:
                     raise KeyboardInterrupt
 
-            def load_dhcp_static_config(filename):
-                result = ['', dict()]
-
-                try:
-                    static_config = io.open(filename, 'r')
-                except IOError:
-                    result[0] = "Failed to open {0}".format(filename)
-                    return result
-
-                try:
-                    result[1] = json.load(static_config)
-                    static_config.close()
-                except ValueError:
-                    result[0] = "{0} does not contain valid json".format(filename)
-                    return result
-
-                return result
-
-            if args.STATIC_CONFIG:
-                message, loaded_statics = load_dhcp_static_config(args.STATIC_CONFIG)
-                if message:
-                    sys.exit(message)
-            else:
-                loaded_statics = dict()
-
             # setup DHCP logger
             dhcp_logger = helpers.get_child_logger(sys_logger, 'DHCP')
             if args.DHCP_MODE_PROXY:
@@ -296,6 +312,7 @@ def main():
                 mode_verbose = do_verbose('dhcp'),
                 whitelist = args.DHCP_WHITELIST,
                 static_config = loaded_statics,
+                static_config_file = args.STATIC_CONFIG,
                 logger = dhcp_logger,
                 saveleases = args.LEASES_FILE)
             signal.signal(signal.SIGINT, dhcp_export_leases)
@@ -321,7 +338,8 @@ def main():
                     logger = http_logger,
                     port = args.HTTP_PORT,
                     netboot_directory = args.NETBOOT_DIR,
-                    ip = args.HTTP_SERVER_IP)
+                    ip = args.HTTP_SERVER_IP,
+                    virtual_files = virtual_files)
             httpd = threading.Thread(target = http_server.listen)
             httpd.daemon = True
             httpd.start()
@@ -356,6 +374,11 @@ def main():
 
     except KeyboardInterrupt:
         sys.exit('\nShutting down PyPXE...\n')
+    finally:
+        if tftp_server:
+            # stops any worker processes, then reports what they all did
+            tftp_server.shutdown()
+            sys_logger.info('TFTP statistics: {0}'.format(tftp_server.statistics()))
 
 if __name__ == '__main__':
     main()
@@ -7,66 +7,297 @@ This file contains classes and functions that implement the PyPXE TFTP service
 import socket
 import struct
 import os
-import select
+import sys
+import signal
+import json
+import mmap
+import selectors
 import time
 import logging
-import math
+import threading
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pypxe import helpers
 
+# getsockopt() level for the path MTU of a connected socket; Linux only
+IP_MTU = getattr(socket, 'IP_MTU', 14 if sys.platform.startswith('linux') else None)
+
+class MalformedPacketError(Exception):
+    pass
+
 class ParentSocket(socket.socket):
     '''Subclassed socket.socket to enable a link-back to the client object.'''
     parent = None
 
+class BlockCache:
+    '''
+        Size-bounded LRU cache of file blocks shared by every client of a
+        TFTPD. Blocks are keyed by (path, mtime, blksize, block) so a changed
+        file can never be served from stale blocks; the blocks of the older
+        version are dropped as soon as the new one is cached.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size # bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.blocks = OrderedDict()
+        self.paths = {} # path -> (mtime, set of cached keys)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the cached block for key, or None.'''
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        '''Caches a block, evicting the least recently used ones.'''
+        if len(data) > self.max_size:
+            return
+        path, mtime = key[0], key[1]
+        with self.lock:
+            if key in self.blocks:
+                return
+            if path in self.paths and self.paths[path][0] != mtime:
+                self.invalidate(path)
+            self.paths.setdefault(path, (mtime, set()))[1].add(key)
+            self.blocks[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                old_key, old_data = self.blocks.popitem(last = False)
+                self.forget(old_key, old_data)
+
+    def invalidate(self, path):
+        '''Drops every cached block of path; the lock must be held.'''
+        for key in self.paths[path][1].copy():
+            self.forget(key, self.blocks.pop(key))
+
+    def forget(self, key, data):
+        '''Bookkeeping for a block removed from the cache.'''
+        self.size -= len(data)
+        keys = self.paths[key[0]][1]
+        keys.discard(key)
+        if not keys:
+            del self.paths[key[0]]
+
 class Client:
-    '''Client instance for TFTPD.'''
+    '''
+        Client instance for TFTPD. There is one for every transfer, so the
+        state lives in slots and settings are read from the parent TFTPD.
+    '''
+    __slots__ = ('parent', 'logger', 'sock', 'message', 'address', 'data_address',
+                 'retries', 'acked', 'sent', 'blksize', 'windowsize', 'fast_resent',
+                 'rto', 'srtt', 'rttvar', 'adaptive', 'retransmitted', 'sent_time',
+                 'deadline', 'timer', 'dead', 'fh', 'filename', 'filesize', 'mtime',
+                 'lastblock', 'tsize', 'changed_blksize', 'changed_windowsize',
+                 'changed_timeout', 'multicast', 'view', 'header', 'ring', 'pending',
+                 'waiting')
+
     def __init__(self, mainsock, parent):
-        self.default_retries = parent.default_retries
-        self.timeout = parent.timeout
-        self.ip = parent.ip
-        self.message, self.address = mainsock.recvfrom(1024)
-        self.logger = helpers.get_child_logger(parent.logger, 'Client.{0}'.format(self.address))
-        self.netboot_directory = parent.netboot_directory
+        self.setup(parent)
+        self.message, self.address = mainsock.recvfrom(65536)
+        self.data_address = self.address
+        self.logger = helpers.ContextAdapter(helpers.get_child_logger(parent.logger, 'Client'), self.address)
         self.logger.debug('Receiving request...')
-        self.retries = self.default_retries
-        self.block = 1
+
+    def setup(self, parent):
+        '''Initialises the state of a transfer that has not started yet.'''
+        self.parent = parent
+        self.sock = None # our own socket, once a request is accepted
+        self.retries = self.parent.default_retries
+        self.acked = 0 # last block acknowledged by the client
+        self.sent = 0 # last block sent to the client
         self.blksize = 512
-        self.sent_time = float('inf')
+        self.windowsize = 1
+        self.fast_resent = False
+        # retransmission timeout, adapted to the measured RTT (RFC6298)
+        self.rto = min(1, self.parent.timeout)
+        self.srtt = None
+        self.rttvar = 0
+        self.adaptive = True
+        self.retransmitted = False # Karn's algorithm
+        self.sent_time = 0 # when the current window was started
+        self.deadline = float('inf') # retransmit time
+        self.timer = None # deadline currently held in the timer heap
         self.dead = False
         self.fh = None
         self.filename = ''
-        self.wrap = 0
-        self.arm_wrap = False
-        self.handle() # message from the main socket
+        self.multicast = False
+        self.view = None # shared mapping of the file for zero-copy sends
+        self.header = None
+        # read-ahead through the I/O threads: block -> data read so far,
+        # and the blocks still being read
+        self.ring = {} if parent.io_pool else None
+        self.pending = set() if parent.io_pool else None
+        self.waiting = False
 
     def ready(self):
         '''Called when there is something to be read on our socket.'''
-        self.message = self.sock.recv(1024)
+        self.message, address = self.sock.recvfrom(65536)
+        if address != self.address:
+            self.logger.debug('Ignoring message from unknown transfer ID {0}'.format(address))
+            return
         self.handle()
 
-    def send_block(self):
+    def send_block(self, block):
         '''
-            Sends the next block of data, setting the timeout and retry
-            variables accordingly.
+            Sends a single block of data. Returns False, without sending,
+            if the block is still being read by the I/O threads.
         '''
-        data = None
-        try:
-            self.fh.seek(self.blksize * (self.block - 1))
-            data = self.fh.read(self.blksize)
-        except:
-            self.logger.error('Error while reading block {0}'.format(self.block))
-            self.dead = True
-            return
+        if self.view is not None:
+            # zero-copy: our header and a slice of the mapping go out as is
+            offset = self.blksize * (block - 1)
+            struct.pack_into('!HH', self.header, 0, 3, block % 65536)
+            self.sock.sendmsg([self.header, self.view[offset:offset + self.blksize]], [], 0, self.data_address)
+            self.parent.stats['blocks'] += 1
+            self.logger.debug('Sending block {0}/{1}'.format(block, self.lastblock))
+            return True
+        if self.parent.io_pool:
+            if block not in self.ring:
+                self.prefetch() # may find it in the block cache
+            data = self.ring.get(block)
+            if data is None:
+                return False
+        else:
+            key = (self.filename, self.mtime, self.blksize, block)
+            data = self.parent.block_cache.get(key) if self.parent.block_cache else None
+            if data is None:
+                try:
+                    data = os.pread(self.fh.fileno(), self.blksize, self.blksize * (block - 1))
+                except:
+                    self.logger.error('Error while reading block {0}'.format(block))
+                    self.complete()
+                    return True
+                if self.parent.block_cache:
+                    self.parent.block_cache.put(key, data)
         # opcode 3 == DATA, wraparound block number
-        response = struct.pack('!HH', 3, self.block % 65536)
+        response = struct.pack('!HH', 3, block % 65536)
         response += data
-        self.sock.sendto(response, self.address)
-        self.logger.debug('Sending block {0}/{1}'.format(self.block, self.lastblock))
-        self.retries -= 1
+        self.sock.sendto(response, self.data_address)
+        self.parent.stats['blocks'] += 1
+        self.logger.debug('Sending block {0}/{1}'.format(block, self.lastblock))
+        return True
+
+    def prefetch(self):
+        '''
+            Makes sure the blocks of the current window and the readahead
+            blocks after it are in the ring or being read by the I/O
+            threads, and drops the blocks which have been acknowledged.
+        '''
+        for block in [block for block in self.ring if block <= self.acked]:
+            del self.ring[block]
+        last = min(self.acked + self.windowsize + self.parent.readahead, self.lastblock)
+        for block in range(max(self.acked + 1, 1), last + 1):
+            if block in self.ring or block in self.pending:
+                continue
+            key = (self.filename, self.mtime, self.blksize, block)
+            data = self.parent.block_cache.get(key) if self.parent.block_cache else None
+            if data is not None:
+                self.ring[block] = data
+                continue
+            self.pending.add(block)
+            self.parent.io_pool.submit(self.read_ahead, block)
+
+    def read_ahead(self, block):
+        '''Reads a block; runs in an I/O thread.'''
+        try:
+            data = os.pread(self.fh.fileno(), self.blksize, self.blksize * (block - 1))
+        except (OSError, ValueError) as error:
+            data = error
+        self.parent.read_done(self, block, data)
+
+    def block_read(self, block, data):
+        '''Called from the event loop with a block an I/O thread has read.'''
+        self.pending.discard(block)
+        if self.dead:
+            if not self.pending and self.fh:
+                self.fh.close() # complete() left it to us
+                self.fh = None
+            return
+        if isinstance(data, Exception):
+            self.logger.error('Error while reading block {0}'.format(block))
+            self.complete()
+            return
+        if self.parent.block_cache:
+            self.parent.block_cache.put((self.filename, self.mtime, self.blksize, block), data)
+        if block > self.acked:
+            self.ring[block] = data
+        if self.waiting:
+            self.waiting = False
+            self.send_window()
+
+    def send_window(self):
+        '''
+            Sends the blocks of the current window which have not been sent
+            yet and restarts the timeout. The window holds up to windowsize
+            blocks following the last acknowledged one (RFC7440); block 0 is
+            the OACK, which is always acknowledged on its own.
+        '''
+        if self.acked < 0:
+            last = 0
+        else:
+            last = min(self.acked + self.windowsize, self.lastblock)
+        while self.sent < last and not self.dead:
+            if self.sent < 0:
+                self.reply_options()
+            elif not self.send_block(self.sent + 1):
+                # block_read() carries on once the block is in memory
+                self.waiting = True
+                return
+            self.sent += 1
+        if self.parent.io_pool and not self.dead:
+            self.prefetch()
         self.sent_time = time.time()
+        self.deadline = self.sent_time + self.rto
+        self.parent.schedule(self)
+
+    def retransmit(self):
+        '''Resends everything after the last acknowledged block.'''
+        self.logger.debug('Timeout waiting for ACK of block {0}, resending'.format(self.sent))
+        if self.rto >= self.parent.timeout or not self.adaptive:
+            # retries are only spent once the timeout has backed off fully,
+            # so a short RTT doesn't shorten the time we wait for a client
+            self.retries -= 1
+        self.retransmitted = True
+        self.parent.stats['retransmits'] += 1
+        if self.adaptive:
+            # exponential backoff, undone by the next RTT measurement
+            self.rto = min(self.rto * 2, self.parent.timeout)
+        self.sent = self.acked
+        self.send_window()
+
+    def update_rtt(self):
+        '''
+            Updates the smoothed RTT and its variation from the ACK which
+            just arrived for the current window, and derives the timeout
+            from them as TCP does (RFC6298). Samples are only taken when
+            nothing in the window was retransmitted.
+        '''
+        if self.retransmitted:
+            self.retransmitted = False
+            return
+        if not self.adaptive:
+            return
+        rtt = time.time() - self.sent_time
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = max(self.parent.min_timeout, min(self.srtt + 4 * self.rttvar, self.parent.timeout))
 
     def no_ack(self):
         '''Determines if we timed out waiting for an ACK from the client.'''
-        if self.sent_time + self.timeout < time.time():
+        if self.deadline < time.time():
             return True
         return False
 
@@ -76,6 +307,17 @@ class Client:
             return True
         return False
 
+    def timed_out(self):
+        '''Called by the timer heap once our deadline has passed.'''
+        if self.no_retries():
+            # if we have run out of retries, kill the client
+            self.logger.info('Timeout while sending {0}'.format(self.filename))
+            self.parent.stats['timeouts'] += 1
+            self.complete()
+        else:
+            # if we haven't received an ACK in timeout time, retry
+            self.retransmit()
+
     def valid_mode(self):
         '''Determines if the file read mode octet; if not, send an error.'''
         mode = self.message.split(b'\x00')[1]
@@ -86,16 +328,23 @@ class Client:
     def check_file(self):
         '''
             Determines if the file exists under the netboot_directory,
-            and if it is a file; if not, send an error.
+            and if it is a file, opening it through the shared file cache;
+            if not, send an error.
         '''
-        filename = self.message.split(b'\x00')[0].decode('ascii').lstrip('/')
         try:
-            filename = helpers.normalize_path(self.netboot_directory, filename)
+            filename = self.message.split(b'\x00')[0].decode('ascii').lstrip('/')
+        except UnicodeDecodeError:
+            raise MalformedPacketError('Filename is not ASCII')
+        try:
+            self.fh = self.parent.files.open(filename, self.address)
         except helpers.PathTraversalException:
             self.send_error(2, 'Path traversal error', filename = filename)
             return False
-        if os.path.lexists(filename) and os.path.isfile(filename):
-            self.filename = filename
+        except OSError:
+            self.send_error(2, 'Access violation', filename = filename)
+            return False
+        if self.fh is not None:
+            self.filename = self.fh.path
             return True
         self.send_error(1, 'File Not Found', filename = filename)
         return False
@@ -106,33 +355,102 @@ class Client:
             block based on the filesize and blocksize.
         '''
         options = self.message.split(b'\x00')[2: -1]
-        options = dict(zip((i.decode('ascii') for i in options[0::2]), map(int, options[1::2])))
-        self.changed_blksize = 'blksize' in options
-        if self.changed_blksize:
-            self.blksize = options['blksize']
-        self.lastblock = math.ceil(self.filesize / float(self.blksize))
+        # names which are not ASCII can't be any option we know, so are ignored
+        options = dict(zip((i.decode('ascii', 'replace').lower() for i in options[0::2]), options[1::2]))
+        for name in ('blksize', 'windowsize', 'timeout', 'tsize'):
+            try:
+                options[name] = int(options[name])
+            except KeyError:
+                pass
+            except ValueError:
+                del options[name] # ignored, as any option we don't understand
+        # multicast (RFC2090) carries no value in the request
+        self.multicast = 'multicast' in options and self.parent.multicast
+        if self.multicast:
+            # the session is driven by one master client at a time
+            options.pop('windowsize', None)
+        # RFC2348 allows blocks of 8 to 65464 bytes
+        if not 8 <= options.get('blksize', 512) <= 65464:
+            del options['blksize']
+        self.changed_blksize = False
+        if 'blksize' in options or (options and self.parent.min_blksize > 512):
+            self.negotiate_blksize(options.get('blksize'))
+        # the window is only acknowledged if we allow more than lock-step
+        self.changed_windowsize = 'windowsize' in options and self.parent.max_windowsize > 1
+        if self.changed_windowsize:
+            self.windowsize = max(1, min(options['windowsize'], self.parent.max_windowsize))
+        # the final block is always short, and empty for exact multiples
+        self.lastblock = self.filesize // self.blksize + 1
         self.tsize = True if 'tsize' in options else False
+        # a client chosen timeout (RFC2349) replaces the adaptive one
+        self.changed_timeout = 1 <= options.get('timeout', 0) <= 255
+        if self.changed_timeout:
+            self.rto = options['timeout']
+            self.adaptive = False
         if self.filesize > (2 ** 16) * self.blksize:
             self.logger.warning('Request too big, attempting transfer anyway.')
             self.logger.debug('Details: Filesize {0} is too big for blksize {1}.'.format(self.filesize, self.blksize))
         if len(options):
-            # we need to know later if we actually had any options
-            self.block = 0
+            # the OACK takes the place of block 0
+            self.acked = self.sent = -1
             return True
         else:
             return False
 
+    def negotiate_blksize(self, requested):
+        '''
+            Picks the blksize for the transfer: the one the client asked for,
+            raised to min_blksize and capped so DATA packets fit in the path
+            MTU, as fragmented blocks are lost far more often.
+        '''
+        blksize = max(requested or 512, self.parent.min_blksize)
+        mtu = self.path_mtu() if self.parent.path_mtu else None
+        if mtu:
+            # IP, UDP and TFTP headers
+            blksize = min(blksize, mtu - 32)
+            self.logger.debug('Path MTU is {0}, using blksize {1}'.format(mtu, blksize))
+        blksize = min(blksize, 65464)
+        if requested or blksize > 512:
+            self.blksize = blksize
+            self.changed_blksize = True
+
+    def path_mtu(self):
+        '''
+            Returns the MTU of the route to the client, as known by the kernel,
+            or None if we can't tell.
+        '''
+        if IP_MTU is None:
+            return None
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect(self.address) # only picks the route, nothing is sent
+            return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        except OSError:
+            return None
+        finally:
+            probe.close()
+
     def reply_options(self):
         '''Acknowledges any options received.'''
+        self.sock.sendto(self.oack(), self.address)
+
+    def oack(self):
+        '''Builds the OACK packet for the options we have agreed to.'''
         # only called if options, so send them all
         response = struct.pack("!H", 6)
         if self.changed_blksize:
             response += b'blksize' + b'\x00'
             response += str(self.blksize).encode('ascii') + b'\x00'
+        if self.changed_windowsize:
+            response += b'windowsize' + b'\x00'
+            response += str(self.windowsize).encode('ascii') + b'\x00'
+        if self.changed_timeout:
+            response += b'timeout' + b'\x00'
+            response += str(self.rto).encode('ascii') + b'\x00'
         if self.tsize:
             response += b'tsize' + b'\x00'
             response += str(self.filesize).encode('ascii') + b'\x00'
-        self.sock.sendto(response, self.address)
+        return response
 
     def new_request(self):
         '''
@@ -142,23 +460,31 @@ class Client:
         '''
         self.sock = ParentSocket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.ip, 0))
-        # used by select() to find ready clients
+        self.sock.bind((self.parent.ip, 0))
+        # registered once, the reactor hands us back via the key data
         self.sock.parent = self
+        self.parent.selector.register(self.sock, selectors.EVENT_READ, self)
+        if self.message.count(b'\x00') < 1:
+            raise MalformedPacketError('Request has no mode')
         if not self.valid_mode() or not self.check_file():
             # some clients just ACK the error (wrong code?)
             # so forcefully shutdown
             self.complete()
             return
-        self.fh = open(self.filename, 'rb')
-        self.filesize = os.path.getsize(self.filename)
+        self.filesize = self.fh.size
+        self.mtime = self.fh.mtime
+        if self.parent.zero_copy:
+            self.view = self.parent.map_file(self.filename, self.mtime, self.fh)
+            self.header = bytearray(4) # DATA opcode and block number
         self.logger.info('File {0} ({1} bytes) requested'.format(self.filename, self.filesize))
-        if not self.parse_options():
-            # no options received so start transfer
-            if self.block == 1:
-                self.send_block()
+        if self.parse_options():
+            self.logger.debug('Negotiated blksize {0}, windowsize {1}'.format(self.blksize, self.windowsize))
+        if self.multicast:
+            # the session takes over from here
+            self.parent.join_multicast(self)
             return
-        self.reply_options() # we received some options so ACK those first
+        # starts the transfer, or sends the OACK first if we had options
+        self.send_window()
 
     def send_error(self, code = 1, message = 'File Not Found', filename = ''):
         '''
@@ -181,6 +507,7 @@ class Client:
         response += message.encode('ascii')
         response += b'\x00'
         self.sock.sendto(response, self.address)
+        self.parent.stats['errors'] += 1
         self.logger.info('Sending {0}: {1} {2}'.format(code, message, filename))
 
     def complete(self):
@@ -188,57 +515,236 @@ class Client:
             Closes a file and socket after sending it
             and marks ourselves as dead to be cleaned up.
         '''
+        if self.dead:
+            return
+        if self.fh is not None and not self.pending:
+            self.fh.close() # otherwise closed once the reads are done
+            self.fh = None
+        if self.view is not None:
+            self.parent.unmap_file(self.filename, self.mtime)
+            self.view = None
         try:
-            self.fh.close()
-        except AttributeError:
-            pass # we have not opened yet or file-not-found
+            self.parent.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass # never registered
         self.sock.close()
         self.dead = True
+        self.parent.ongoing.discard(self)
 
     def handle(self):
         '''Takes the message from the parent socket and act accordingly.'''
         # if addr not in ongoing, call this, else ready()
+        if len(self.message) < 2:
+            raise MalformedPacketError('Packet has no opcode')
         [opcode] = struct.unpack('!H', self.message[:2])
         if opcode == 1:
+            self.parent.stats['requests'] += 1
             self.message = self.message[2:]
             self.new_request()
-        elif opcode == 4:
+        elif opcode == 4 and self.sock is not None:
+            if len(self.message) < 4:
+                raise MalformedPacketError('ACK has no block number')
             [block] = struct.unpack('!H', self.message[2:4])
-            if block == 0 and self.arm_wrap:
-                self.wrap += 1
-                self.arm_wrap = False
-            if block == 32768:
-                self.arm_wrap = True
-            if block < self.block % 65536:
-                self.logger.warning('Ignoring duplicated ACK received for block {0}'.format(self.block))
-            elif block > self.block % 65536:
-                self.logger.warning('Ignoring out of sequence ACK received for block {0}'.format(self.block))
-            elif block + self.wrap * 65536 == self.lastblock:
-                if self.filesize % self.blksize == 0:
-                    self.block = block + 1
-                    self.send_block()
-                self.logger.info('Completed sending {0}'.format(self.filename))
-                self.complete()
-            else:
-                self.block = block + 1
-                self.retries = self.default_retries
-                self.send_block()
+            self.handle_ack(block)
+        elif opcode == 5 and self.sock is not None:
+            # the client gave up, such as on an OACK it rejects (RFC2347)
+            message = self.message[4:].split(b'\x00')[0].decode('ascii', 'replace')
+            self.logger.info('Client sent error: {0}'.format(message))
+            self.client_error()
         elif opcode == 2:
             # write request
             self.sock = ParentSocket(socket.AF_INET, socket.SOCK_DGRAM)
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.bind((self.ip, 0))
-            # used by select() to find ready clients
+            self.sock.bind((self.parent.ip, 0))
             self.sock.parent = self
             # send error
             self.send_error(4, 'Write support not implemented')
+            self.complete()
+        elif self.sock is None:
+            # a stray ACK, ERROR or junk on the main socket belongs to no
+            # transfer; drop it rather than keep a Client around for it
+            self.logger.debug('Ignoring opcode {0} on the main socket'.format(opcode))
             self.dead = True
 
+    def client_error(self):
+        '''Ends the transfer the client sent an ERROR for.'''
+        self.complete()
+
+    def abort(self):
+        '''Ends the transfer after a packet we could not handle.'''
+        if self.sock is None:
+            self.dead = True # nothing was set up for it yet
+            return
+        if not self.dead:
+            try:
+                self.send_error(4, 'Illegal TFTP operation')
+            except OSError:
+                pass
+        self.complete()
+
+    def handle_ack(self, block):
+        '''Moves the window on, or finishes, according to an ACK.'''
+        # wraparound block number, relative to the last ACK
+        block = self.acked + (block - self.acked) % 65536
+        if block == self.acked and self.windowsize > 1 and not self.fast_resent:
+            # the client timed out on a gap, so resend the window once;
+            # further duplicates wait for our own timeout
+            self.logger.debug('Duplicated ACK received for block {0}, resending window'.format(block))
+            self.fast_resent = True
+            self.retransmitted = True
+            self.parent.stats['retransmits'] += 1
+            self.sent = self.acked
+            self.send_window()
+        elif block == self.acked:
+            self.logger.warning('Ignoring duplicated ACK received for block {0}'.format(block))
+        elif block > self.sent:
+            self.logger.warning('Ignoring out of sequence ACK received for block {0}'.format(block))
+        elif block == self.lastblock:
+            self.finished()
+        else:
+            # anything after a short ACK was lost, so continue from it
+            self.update_rtt()
+            self.acked = self.sent = block
+            self.retries = self.parent.default_retries
+            self.fast_resent = False
+            self.send_window()
+
+    def finished(self):
+        '''Called once the client acknowledged the last block.'''
+        self.logger.info('Completed sending {0}'.format(self.filename))
+        self.parent.stats['completed'] += 1
+        if self.parent.block_cache:
+            self.logger.debug('Block cache: {0} hits, {1} misses'.format(self.parent.block_cache.hits, self.parent.block_cache.misses))
+        self.complete()
+
+class MulticastSession(Client):
+    '''
+        Serves one file to a group of clients at once (RFC2090). DATA goes
+        to the multicast group and only the master client, the first in
+        members, acknowledges it. Once the master has the whole file the
+        next member becomes master and acknowledges the block before the
+        first one it missed, until every member is done.
+    '''
+    __slots__ = ('group', 'members')
+
+    def __init__(self, client, group):
+        self.setup(client.parent)
+        self.logger = helpers.ContextAdapter(helpers.get_child_logger(self.parent.logger, 'Multicast'), group)
+        self.group = group
+        self.data_address = group
+        self.members = deque()
+        # take over the file and options negotiated by the first client
+        for name in ('filename', 'fh', 'filesize', 'mtime', 'blksize', 'lastblock',
+                     'changed_blksize', 'changed_windowsize', 'changed_timeout',
+                     'tsize', 'rto', 'adaptive', 'view', 'header'):
+            setattr(self, name, getattr(client, name))
+        client.fh = None
+        client.view = None
+        self.multicast = True
+        self.sock = ParentSocket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.parent.multicast_ttl)
+        if self.parent.ip != '0.0.0.0':
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.parent.ip))
+        self.sock.bind((self.parent.ip, 0))
+        self.sock.parent = self
+        self.parent.selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def join(self, client):
+        '''Adds a client, which becomes master if it is the only member.'''
+        self.members.append(client.address)
+        self.logger.info('{0} joined the transfer of {1}'.format(client.address, self.filename))
+        if len(self.members) == 1:
+            self.next_master()
+        else:
+            self.reply_options(client.address)
+        # the client's own socket is not used for the transfer
+        client.complete()
+
+    def next_master(self):
+        '''Hands the transfer to the next member, or ends the session.'''
+        if not self.members:
+            self.complete()
+            return
+        self.address = self.members[0]
+        self.logger.debug('{0} is the master client'.format(self.address))
+        self.retries = self.parent.default_retries
+        # the OACK, as block 0, tells the new master to start ACKing
+        self.acked = self.sent = -1
+        self.send_window()
+
+    def reply_options(self, address = None):
+        '''Sends the OACK, telling address whether it is the master.'''
+        master = address is None
+        response = self.oack()
+        response += b'multicast' + b'\x00'
+        response += '{0},{1},{2}'.format(self.group[0], self.group[1], int(master)).encode('ascii') + b'\x00'
+        self.sock.sendto(response, self.address if master else address)
+
+    def handle_ack(self, block):
+        '''
+            The master acknowledges the block before the first one it still
+            needs, which may lie beyond anything sent since it became master.
+        '''
+        if self.acked >= 0:
+            # wraparound block number, relative to the last ACK
+            block = self.acked + (block - self.acked) % 65536
+        if block == self.acked or block > self.lastblock:
+            self.logger.debug('Ignoring ACK received for block {0}'.format(block))
+        elif block == self.lastblock:
+            self.finished()
+        else:
+            if block <= self.sent:
+                self.update_rtt()
+            self.acked = self.sent = block
+            self.retries = self.parent.default_retries
+            self.send_window()
+
+    def finished(self):
+        '''The master has the whole file; move on to the next member.'''
+        self.logger.info('Completed sending {0} to {1}'.format(self.filename, self.address))
+        self.parent.stats['completed'] += 1
+        self.members.popleft()
+        self.next_master()
+
+    def timed_out(self):
+        '''A master which stops ACKing is dropped from the session.'''
+        if not self.no_retries():
+            self.retransmit()
+            return
+        self.logger.info('Timeout while sending {0} to {1}'.format(self.filename, self.address))
+        self.parent.stats['timeouts'] += 1
+        self.members.popleft()
+        self.next_master()
+
+    def client_error(self):
+        '''The master gave up, so the next member takes over.'''
+        self.members.popleft()
+        self.next_master()
+
+    def abort(self):
+        '''Drops the master after a packet we could not handle.'''
+        if self.dead:
+            return
+        try:
+            self.send_error(4, 'Illegal TFTP operation')
+        except OSError:
+            pass
+        self.members.popleft()
+        self.next_master()
+
+    def complete(self):
+        '''Closes the session and gives its group address back.'''
+        if self.dead:
+            return
+        Client.complete(self)
+        self.parent.leave_multicast(self)
+
 
 class TFTPD:
     '''
         This class implements a read-only TFTP server
-        implemented from RFC1350 and RFC2348
+        implemented from RFC1350, RFC2090, RFC2348, RFC2349 and RFC7440
     '''
     def __init__(self, **server_settings):
         self.ip = server_settings.get('ip', '0.0.0.0')
@@ -249,9 +755,32 @@ class TFTPD:
         self.logger = server_settings.get('logger', None)
         self.default_retries = server_settings.get('default_retries', 3)
         self.timeout = server_settings.get('timeout', 5)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.ip, self.port))
+        self.min_timeout = server_settings.get('min_timeout', 0.05)
+        self.max_windowsize = int(server_settings.get('max_windowsize', 64))
+        block_cache_size = int(server_settings.get('block_cache_size', 64 * 1024 * 1024))
+        self.block_cache = BlockCache(block_cache_size) if block_cache_size > 0 else None
+        self.multicast = server_settings.get('multicast', False)
+        self.multicast_address = server_settings.get('multicast_address', '239.255.69.1')
+        self.multicast_port = int(server_settings.get('multicast_port', 1758))
+        self.multicast_ttl = int(server_settings.get('multicast_ttl', 1))
+        self.path_mtu = server_settings.get('path_mtu', True)
+        self.min_blksize = int(server_settings.get('min_blksize', 0))
+        self.files = helpers.get_file_cache(self.netboot_directory)
+        for provider in server_settings.get('virtual_files', []):
+            if provider not in self.files.providers:
+                self.files.providers.append(provider)
+        self.zero_copy = server_settings.get('zero_copy', False) and hasattr(socket.socket, 'sendmsg')
+        self.io_threads = int(server_settings.get('io_threads', 0)) if hasattr(os, 'pread') else 0
+        self.readahead = int(server_settings.get('readahead', 16))
+        self.io_pool = None # started by serve(), each worker has its own
+        self.workers = int(server_settings.get('workers', 1))
+        if self.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            self.workers = 1 # warned about below, once we have a logger
+        self.sock = self.bind_socket()
+
+        # epoll/kqueue where available; only ready sockets cost anything
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
 
         # setup logger
         if self.logger == None:
@@ -272,28 +801,386 @@ class TFTPD:
         self.logger.debug('Server IP: {0}'.format(self.ip))
         self.logger.debug('Server Port: {0}'.format(self.port))
         self.logger.debug('Network Boot Directory: {0}'.format(self.netboot_directory))
+        self.logger.debug('Block Cache Size: {0}'.format(block_cache_size))
+        self.logger.debug('Worker Processes: {0}'.format(self.workers))
+        self.logger.debug('Zero-copy Sends: {0}'.format(self.zero_copy))
+        self.logger.debug('I/O Threads: {0}'.format(self.io_threads))
+        if self.multicast:
+            self.logger.debug('Multicast Groups: {0}:{1}'.format(self.multicast_address, self.multicast_port))
+        if int(server_settings.get('workers', 1)) > 1 and self.workers == 1:
+            self.logger.warning('SO_REUSEPORT is not supported, running a single TFTP worker.')
 
-        self.ongoing = []
+        self.ongoing = set()
+        # min-heap of (deadline, sequence, client), see schedule()
+        self.timers = []
+        self.timer_sequence = itertools.count()
+
+        # transfer counters; the supervisor of worker processes sums
+        # the counters reported by each of them in worker_stats
+        self.stats = dict.fromkeys(('requests', 'completed', 'timeouts', 'errors', 'blocks', 'retransmits'), 0)
+        self.worker_stats = {}
+        self.lifeline = None
+        self.supervisor = None # (pid, statistics pipe)
+        self.stopped = threading.Event()
+        self.worker_index = 0
+
+        # (filename, mtime, blksize) -> MulticastSession
+        self.multicast_sessions = {}
+
+        # (filename, mtime) -> [mmap, memoryview, users]
+        self.mappings = {}
+
+        if self.workers > 1:
+            self.start_supervisor()
+
+    def map_file(self, filename, mtime, fh):
+        '''
+            Returns a read-only memoryview of the file, mapped once and
+            shared by every client sending the same version of it.
+        '''
+        key = (filename, mtime)
+        mapping = self.mappings.get(key)
+        if mapping is None:
+            if fh.size:
+                mapped = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+                mapping = [mapped, memoryview(mapped), 0]
+            else:
+                mapping = [None, memoryview(b''), 0] # empty files can't be mapped
+            self.mappings[key] = mapping
+        mapping[2] += 1
+        return mapping[1]
+
+    def unmap_file(self, filename, mtime):
+        '''Drops a reference to a mapping, unmapping it after the last.'''
+        key = (filename, mtime)
+        mapping = self.mappings[key]
+        mapping[2] -= 1
+        if not mapping[2]:
+            del self.mappings[key]
+            mapping[1].release()
+            if mapping[0] is not None:
+                mapping[0].close()
+
+    def join_multicast(self, client):
+        '''
+            Adds a client which asked for multicast to the session serving
+            the same version of the file with the same blksize, starting a
+            session on the lowest free group address if there is none.
+            Workers take turns through the group addresses, worker i using
+            every workers-th address from the i-th on, so sessions of
+            different workers never share a group.
+        '''
+        key = (client.filename, client.mtime, client.blksize)
+        session = self.multicast_sessions.get(key)
+        if session is None:
+            used = set(session.group for session in self.multicast_sessions.values())
+            base = struct.unpack('!I', socket.inet_aton(self.multicast_address))[0]
+            for offset in itertools.count():
+                address = base + offset * self.workers + self.worker_index
+                group = (socket.inet_ntoa(struct.pack('!I', address)), self.multicast_port)
+                if group not in used:
+                    break
+            session = MulticastSession(client, group)
+            self.multicast_sessions[key] = session
+            self.ongoing.add(session)
+        session.join(client)
+
+    def leave_multicast(self, session):
+        '''Forgets a session once its last member is done.'''
+        for key, value in list(self.multicast_sessions.items()):
+            if value is session:
+                del self.multicast_sessions[key]
+
+    def bind_socket(self):
+        '''
+            Opens the listening socket; workers each bind their own to the
+            same address with SO_REUSEPORT and the kernel spreads new
+            requests between them.
+        '''
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.workers > 1:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.ip, self.port))
+        return sock
+
+    def statistics(self):
+        '''Returns the transfer and block cache counters of this server.'''
+        if self.worker_stats:
+            totals = dict()
+            for stats in list(self.worker_stats.values()):
+                for name in stats:
+                    totals[name] = totals.get(name, 0) + stats[name]
+            return totals
+        stats = dict(self.stats)
+        if self.block_cache:
+            stats['cache_hits'] = self.block_cache.hits
+            stats['cache_misses'] = self.block_cache.misses
+        return stats
+
+    def schedule(self, client):
+        '''
+            Makes sure the client's deadline is covered by the timer heap.
+            Deadlines usually only move forward, so a client keeps at most
+            one entry which is pushed back when it fires early; entries of
+            dead clients or superseded deadlines are skipped when popped.
+        '''
+        if client.timer is None or client.deadline < client.timer:
+            client.timer = client.deadline
+            heapq.heappush(self.timers, (client.deadline, next(self.timer_sequence), client))
+
+    def run_timers(self):
+        '''Fires every expired timer and returns the time until the next.'''
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, _, client = heapq.heappop(self.timers)
+            if client.dead or when != client.timer:
+                continue
+            client.timer = None
+            if client.deadline > now:
+                self.schedule(client) # we were acknowledged meanwhile
+            else:
+                client.timed_out()
+        if self.timers:
+            return max(0, self.timers[0][0] - now)
+        return None
 
     def listen(self):
         '''This method listens for incoming requests.'''
+        if self.workers > 1:
+            self.collect()
+        else:
+            self.serve()
+
+    def serve(self, lifeline = None, report = None):
+        '''
+            The event loop. Worker processes pass the read end of the
+            supervisor's lifeline pipe, which reaches EOF once the
+            supervisor shuts down, and a pipe to report statistics on.
+        '''
+        if lifeline is not None:
+            self.selector.register(lifeline, selectors.EVENT_READ)
+        if self.io_threads and not self.zero_copy:
+            # the I/O threads hand their blocks over through io_done and
+            # wake us up by writing to io_wakeup
+            self.io_pool = ThreadPoolExecutor(self.io_threads)
+            self.io_done = deque()
+            self.io_wakeup = socket.socketpair()
+            for sock in self.io_wakeup:
+                sock.setblocking(False)
+            self.selector.register(self.io_wakeup[0], selectors.EVENT_READ)
+        reported = None
+        next_report = 0
         while True:
-            # remove complete clients to select doesn't fail
-            for client in self.ongoing:
-                if client.dead:
-                    self.ongoing.remove(client)
-            rlist, _, _ = select.select([self.sock] + [client.sock for client in self.ongoing if not client.dead], [], [], 1)
-            for sock in rlist:
-                if sock == self.sock:
+            # sleep exactly until the next retransmission is due
+            timeout = self.run_timers()
+            if report is not None:
+                now = time.time()
+                if now >= next_report:
+                    next_report = now + 1
+                    stats = self.statistics()
+                    if stats != reported:
+                        os.write(report, (json.dumps(stats) + '\n').encode('ascii'))
+                        reported = stats
+                timeout = min(timeout, next_report - now) if timeout is not None else next_report - now
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.sock:
                     # main socket, so new client
-                    self.ongoing.append(Client(sock, self))
-                else:
+                    client = Client(self.sock, self)
+                    self.handle_packet(client, client.handle)
+                    if not client.dead:
+                        self.ongoing.add(client)
+                elif key.fileobj == lifeline:
+                    self.logger.debug('Supervisor went away, stopping')
+                    os.write(report, (json.dumps(self.statistics()) + '\n').encode('ascii'))
+                    if self.io_pool:
+                        self.io_pool.shutdown()
+                    return
+                elif self.io_pool and key.fileobj is self.io_wakeup[0]:
+                    self.run_io_callbacks()
+                elif not key.data.dead:
                     # client socket, so tell the client object it's ready
-                    sock.parent.ready()
-            # if we haven't received an ACK in timeout time, retry
-            [client.send_block() for client in self.ongoing if client.no_ack()]
-            # if we have run out of retries, kill the client
-            for client in self.ongoing:
-                if client.no_retries():
-                    client.logger.info('Timeout while sending {0}'.format(client.filename))
-                    client.complete()
+                    self.handle_packet(key.data, key.data.ready)
+
+    def handle_packet(self, client, handler):
+        '''
+            Lets a client handle a packet. A packet it can't handle ends its
+            transfer, and never the event loop with every other transfer.
+        '''
+        try:
+            handler()
+        except MalformedPacketError as e:
+            client.logger.info('Dropping malformed packet: {0}'.format(e))
+            client.abort()
+        except Exception:
+            client.logger.exception('Error while handling packet')
+            client.abort()
+
+    def read_done(self, client, block, data):
+        '''Queues a block read by an I/O thread for the event loop.'''
+        self.io_done.append((client, block, data))
+        try:
+            self.io_wakeup[1].send(b'\x00')
+        except (BlockingIOError, InterruptedError):
+            pass # the loop has plenty of wakeups pending already
+
+    def run_io_callbacks(self):
+        '''Passes the blocks read by the I/O threads to their clients.'''
+        try:
+            while self.io_wakeup[0].recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.io_done:
+            client, block, data = self.io_done.popleft()
+            client.block_read(block, data)
+
+    def start_supervisor(self):
+        '''
+            Forks the supervisor process, which forks the worker processes
+            and replaces those which die. It is forked while constructing
+            the server, before the other services start their threads, so
+            neither it nor the workers it forks later can inherit a lock
+            held by another thread. It sends us the statistics of every
+            worker as they change, which listen() keeps in worker_stats.
+        '''
+        self.lifeline = os.pipe()
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write_end)
+            os.close(self.lifeline[0])
+            self.supervisor = (pid, read_end)
+            # the supervisor's first worker serves on our socket now
+            self.selector.unregister(self.sock)
+            self.sock.close()
+            return
+        try:
+            os.close(read_end)
+            os.close(self.lifeline[1])
+            # ^C and friends are for the main process, we follow the lifeline
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGALRM):
+                signal.signal(signum, signal.SIG_DFL)
+            self.supervise(write_end)
+        except:
+            self.logger.exception('TFTP supervisor failed')
+        finally:
+            os._exit(0)
+
+    def spawn_worker(self, index, reports):
+        '''Forks a worker process and registers its statistics pipe.'''
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write_end)
+            reports.register(read_end, selectors.EVENT_READ, pid)
+            self.running_workers[pid] = index
+            return
+        # worker: drop everything belonging to the supervisor
+        try:
+            os.close(read_end)
+            os.close(self.report)
+            for key in list(reports.get_map().values()):
+                if key.fd != self.lifeline[0]:
+                    os.close(key.fd)
+            reports.close()
+            self.selector.close()
+            # the first worker inherits the supervisor's socket
+            if index or self.sock.fileno() == -1:
+                self.sock.close()
+                self.sock = self.bind_socket()
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.sock, selectors.EVENT_READ)
+            self.logger = helpers.get_child_logger(self.logger, 'Worker{0}'.format(index))
+            self.worker_index = index
+            self.worker_stats = {}
+            for name in self.stats:
+                self.stats[name] = 0
+            self.serve(self.lifeline[0], write_end)
+        except:
+            self.logger.exception('TFTP worker {0} failed'.format(index))
+        finally:
+            os._exit(0)
+
+    def supervise(self, report):
+        '''
+            Forks the worker processes, each running its own event loop on a
+            SO_REUSEPORT socket, then collects their statistics (by pid, so
+            the counts of workers which died are kept) and passes them on
+            through report. Workers which die are replaced until the
+            lifeline closes.
+        '''
+        self.report = report
+        self.running_workers = {} # pid -> index
+        reports = selectors.DefaultSelector()
+        reports.register(self.lifeline[0], selectors.EVENT_READ)
+        for index in range(self.workers):
+            self.spawn_worker(index, reports)
+        self.logger.info('Started {0} TFTP workers'.format(self.workers))
+        # the first worker serves on our socket now
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        buffers = {}
+        stopping = False
+        while self.running_workers:
+            changed = False
+            for key, _ in reports.select(1):
+                if key.fd == self.lifeline[0]:
+                    # shutdown(), or the main process went away
+                    reports.unregister(key.fd)
+                    stopping = True
+                    continue
+                data = os.read(key.fd, 65536)
+                if not data:
+                    reports.unregister(key.fd)
+                    os.close(key.fd)
+                    buffers.pop(key.fd, None)
+                    continue
+                lines = (buffers.pop(key.fd, b'') + data).split(b'\n')
+                buffers[key.fd] = lines.pop()
+                for line in lines:
+                    self.worker_stats[key.data] = json.loads(line.decode('ascii'))
+                    changed = True
+            if changed:
+                os.write(report, (json.dumps(self.worker_stats) + '\n').encode('ascii'))
+            for pid, index in list(self.running_workers.items()):
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    del self.running_workers[pid]
+                    if not stopping:
+                        self.logger.error('TFTP worker {0} died, restarting it'.format(index))
+                        self.spawn_worker(index, reports)
+        reports.close()
+        os.write(report, (json.dumps(self.worker_stats) + '\n').encode('ascii'))
+
+    def collect(self):
+        '''
+            Keeps worker_stats up to date from the supervisor process until
+            it exits, after the workers.
+        '''
+        pid, read_end = self.supervisor
+        buffer = b''
+        while True:
+            data = os.read(read_end, 65536)
+            if not data:
+                break
+            lines = (buffer + data).split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                worker_stats = json.loads(line.decode('ascii'))
+                self.worker_stats = dict((int(worker), stats) for worker, stats in worker_stats.items())
+        os.close(read_end)
+        os.waitpid(pid, 0)
+        self.logger.info('TFTP workers stopped: {0}'.format(self.statistics()))
+        self.stopped.set()
+
+    def shutdown(self, timeout = 5):
+        '''
+            Asks the worker processes to exit by closing the lifeline, and
+            waits up to timeout seconds for their final statistics.
+        '''
+        if self.lifeline and self.lifeline[1] is not None:
+            write_end = self.lifeline[1]
+            self.lifeline = (self.lifeline[0], None)
+            os.close(write_end)
+            self.stopped.wait(timeout)
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+from pypxe import helpers
+
+class TemplateFilesTest(unittest.TestCase):
+    '''Rendered files must find the client's binding however its MAC is written.'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.directory.name, 'pxelinux.tpl'), 'w') as template:
+            template.write('$mac $ipaddr $rom\n')
+        static_config = {'dhcp': {'binding': {'aa-bb-cc-dd-ee-01': {'ipaddr': '192.168.2.10',
+                                                                     'rom': 'pxelinux.0'}}}}
+        self.files = helpers.FileCache(self.directory.name)
+        self.files.providers.append(helpers.TemplateFiles({'pxelinux.cfg/01-{mac}': 'pxelinux.tpl',
+                                                           'by-ip/{ip}': 'pxelinux.tpl'},
+                                                          static_config = static_config))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def render(self, filename):
+        entry = self.files.open(filename, ('192.168.2.99', 68))
+        try:
+            return os.pread(entry.fileno(), entry.size, 0).decode('utf-8')
+        finally:
+            entry.close()
+
+    def test_mac_in_any_form(self):
+        for filename in ('pxelinux.cfg/01-aa-bb-cc-dd-ee-01', 'pxelinux.cfg/01-AA:BB:CC:DD:EE:01',
+                         'pxelinux.cfg/01-aabbccddee01'):
+            self.assertEqual(self.render(filename), 'AA:BB:CC:DD:EE:01 192.168.2.10 pxelinux.0\n')
+
+    def test_ip(self):
+        self.assertEqual(self.render('by-ip/192.168.2.10'), 'AA:BB:CC:DD:EE:01 192.168.2.10 pxelinux.0\n')
+
+    def test_unknown_mac(self):
+        self.assertEqual(self.render('pxelinux.cfg/01-aa-bb-cc-dd-ee-02'), 'AA:BB:CC:DD:EE:02 $ipaddr $rom\n')
+
+if __name__ == '__main__':
+    unittest.main()
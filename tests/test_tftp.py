@@ -0,0 +1,116 @@
+import os
+import socket
+import struct
+import tempfile
+import unittest
+
+from pypxe import tftp
+
+class ServerTestCase(unittest.TestCase):
+    '''Runs a server on a free port, whose packets the tests hand over themselves.'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = tftp.TFTPD(ip = '127.0.0.1', port = 0, netboot_directory = self.directory.name)
+        self.address = self.server.sock.getsockname()
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.sock.close()
+        self.server.selector.close()
+        self.directory.cleanup()
+
+    def receive(self):
+        '''Hands the next packet on the main socket to a Client, as serve() does.'''
+        client = tftp.Client(self.server.sock, self.server)
+        self.server.handle_packet(client, client.handle)
+        if not client.dead:
+            self.server.ongoing.add(client)
+        return client
+
+class StrayPacketTest(ServerTestCase):
+    '''Packets on the main socket which are not requests must not leave Clients behind.'''
+
+    def test_stray_ack_and_error(self):
+        for block in range(100):
+            self.sender.sendto(struct.pack('!HH', 4, block), self.address) # ACK
+            self.assertTrue(self.receive().dead)
+            self.sender.sendto(struct.pack('!HH', 5, 0) + b'oops\x00', self.address) # ERROR
+            self.assertTrue(self.receive().dead)
+        self.assertEqual(len(self.server.ongoing), 0)
+
+    def test_unknown_opcode(self):
+        self.sender.sendto(struct.pack('!H', 42) + b'junk', self.address)
+        self.assertTrue(self.receive().dead)
+        self.assertEqual(len(self.server.ongoing), 0)
+
+class MalformedRequestTest(ServerTestCase):
+    '''A malformed request must only end its own transfer.'''
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        with open(os.path.join(self.directory.name, 'boot.bin'), 'wb') as boot:
+            boot.write(b'x' * 100)
+        self.sender.settimeout(1)
+
+    def tearDown(self):
+        for client in list(self.server.ongoing):
+            client.complete()
+        ServerTestCase.tearDown(self)
+
+    def assertError(self, code):
+        message, _ = self.sender.recvfrom(65536)
+        self.assertEqual(struct.unpack('!HH', message[:4]), (5, code))
+
+    def test_truncated_packet(self):
+        self.sender.sendto(b'\x00', self.address)
+        self.assertTrue(self.receive().dead)
+        self.assertEqual(len(self.server.ongoing), 0)
+
+    def test_no_mode(self):
+        self.sender.sendto(struct.pack('!H', 1) + b'boot.bin', self.address)
+        self.assertTrue(self.receive().dead)
+        self.assertError(4)
+
+    def test_filename_not_ascii(self):
+        self.sender.sendto(struct.pack('!H', 1) + b'boot\xff.bin\x00octet\x00', self.address)
+        self.assertTrue(self.receive().dead)
+        self.assertError(4)
+
+    def test_option_not_ascii(self):
+        # an option we don't know, so none is acknowledged
+        self.sender.sendto(struct.pack('!H', 1) + b'boot.bin\x00octet\x00blks\xffize\x001024\x00', self.address)
+        client = self.receive()
+        self.assertFalse(client.dead)
+        message, _ = self.sender.recvfrom(65536)
+        self.assertEqual(message, struct.pack('!H', 6))
+
+    def test_truncated_ack(self):
+        self.sender.sendto(struct.pack('!H', 1) + b'boot.bin\x00octet\x00', self.address)
+        client = self.receive()
+        self.sender.recvfrom(65536)
+        self.sender.sendto(struct.pack('!H', 4) + b'\x00', client.sock.getsockname())
+        self.server.handle_packet(client, client.ready)
+        self.assertTrue(client.dead)
+        self.assertError(4)
+        self.assertEqual(len(self.server.ongoing), 0)
+
+class ClientErrorTest(ServerTestCase):
+    '''An ERROR from the client ends its transfer at once.'''
+
+    def test_rejected_oack(self):
+        with open(os.path.join(self.directory.name, 'boot.bin'), 'wb') as boot:
+            boot.write(b'x' * 100)
+        self.sender.sendto(struct.pack('!H', 1) + b'boot.bin\x00octet\x00blksize\x001024\x00', self.address)
+        client = self.receive()
+        message, _ = self.sender.recvfrom(65536)
+        self.assertEqual(struct.unpack('!H', message[:2]), (6,))
+        self.sender.sendto(struct.pack('!HH', 5, 8) + b'Bad option\x00', client.sock.getsockname())
+        self.server.handle_packet(client, client.ready)
+        self.assertTrue(client.dead)
+        self.assertEqual(len(self.server.ongoing), 0)
+        self.assertEqual(self.server.stats['timeouts'], 0)
+
+if __name__ == '__main__':
+    unittest.main()